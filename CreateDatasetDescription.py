@@ -6,31 +6,33 @@ Created on Wed Feb  9 11:32:24 2022
 @author: patrick
 """
 
-from sys import argv
+import sys
 import json
 import os
 
-# Input from command line
-argumentList = argv[1:]
+from fsutil import atomic_write_text
 
 class DatasetDescrption():
 	
-	def __init__(self):
+	def __init__(self, targetfolder = None, Name = None, DatasetType = None):
 		
 		# DESCRIPTION: initialze class
 		
-		# if no arguments passed, try to create dataset_description.json in current working directory
-		if not argumentList:
-			argumentList[0] = os.getcwd()
+		# if no target folder passed, create dataset_description.json in current working directory
+		if targetfolder is None:
+			targetfolder = os.getcwd()
 		
 		# create target folder if it does not exist
-		if not os.path.isdir(argumentList[0]):
-			print('Target folder for dataset_description.json NOT found: %s Making it...' % argumentList[0])
-			os.mkdir(argumentList[0])
+		if not os.path.isdir(targetfolder):
+			print('Target folder for dataset_description.json NOT found: %s Making it...' % targetfolder)
+			os.makedirs(targetfolder, exist_ok = True)
 		
-		# input variables
-		inputvarList = ['targetfolder', 'Name', 'DatasetType']
-		self.inputvar = {inputvarList[i]: argumentList[i] for i in range(len(argumentList))}
+		# input variables (Name/DatasetType default in create_dataset_description)
+		self.inputvar = {'targetfolder': str(targetfolder)}
+		if Name is not None:
+			self.inputvar['Name'] = Name
+		if DatasetType is not None:
+			self.inputvar['DatasetType'] = DatasetType
 	
 	def create_dataset_description(self):
 		
@@ -40,10 +42,7 @@ class DatasetDescrption():
 		data = {}
 		
 		for elem in default_dict.keys():
-			if elem in self.inputvar.keys():
-				data[elem] = ''.join([val for key, val in self.inputvar.items() if key is elem])
-			else:
-				data[elem] = default_dict[elem]
+			data[elem] = self.inputvar.get(elem, default_dict[elem])
 		
 		data['BIDSVersion'] = 'v1.6.0'
 		data['Authors'] = ['Author 1', 'Author 2']
@@ -52,12 +51,10 @@ class DatasetDescrption():
 	
 	def write_dataset_description(self):
 		
-		# DESCRIPTION: write dataset_description json to file
+		# DESCRIPTION: write dataset_description json to file (atomically, concurrent sessions may create it at the same time)
 		
 		self.json_filename = '/'.join([self.inputvar['targetfolder'], 'dataset_description.json'])
-		jsonFile = open(self.json_filename, 'w')
-		jsonFile.write(self.json_string, indent=2)
-		jsonFile.close()
+		atomic_write_text(self.json_filename, self.json_string)
 	
 	def generate_dataset_description(self):
 		
@@ -67,8 +64,6 @@ class DatasetDescrption():
 
 if __name__ == '__main__':
 	
-	ddobj = DatasetDescrption()
+	# inputs (all optional, in order): targetfolder, Name, DatasetType
+	ddobj = DatasetDescrption(*sys.argv[1:4])
 	ddobj.generate_dataset_description()
-	
-	
-		
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import argparse
+import csv
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
+from pathlib import Path
+
+from source2raw import Source2Raw, Source2RawError
+from participants_registry import ParticipantsRegistry
+from mrraw_index import MRrawIndex
+from tracing import merge_summaries
+import io_scheduler
+from fsutil import atomic_write_json, read_json
+
+inputvarList = ['raw_id', 'project_id', 'cimbi_id', 'mr_id']
+
+def read_manifest(manifest, raw_id = None):
+	
+	# DESCRIPTION: read session manifest (csv or tsv with header), one session per row
+	
+	delimiter = ',' if os.path.splitext(manifest)[1].lower() == '.csv' else '\t'
+	with open(manifest, newline = '') as f:
+		rows = [{key.strip(): (val or '').strip() for key, val in row.items() if key} for row in csv.DictReader(f, delimiter = delimiter)]
+	
+	required = [elem for elem in inputvarList if not (elem == 'raw_id' and raw_id)]
+	sessions = []
+	for idx, row in enumerate(rows):
+		if raw_id:
+			row['raw_id'] = raw_id
+		missing = [elem for elem in required if not row.get(elem)]
+		if missing:
+			sys.exit('Manifest row %s missing required column(s): %s' % (idx + 2, ', '.join(missing)))
+		sessions.append({elem: row[elem] for elem in inputvarList})
+	
+	return sessions
+
+def resolved_mrid(session, mrsource):
+	
+	# DESCRIPTION: source session an mr_id (prefix) resolves to, as in Source2Raw.check_mrid; mr_id as given if it does not resolve
+	# to exactly one session (the conversion reports the error)
+	
+	scanner = Source2Raw.mrscanners.get(session['mr_id'][:1])
+	if scanner is None:
+		return session['mr_id']
+	try:
+		matches = MRrawIndex.for_scanner(Path(mrsource, scanner)).resolve(session['mr_id'])
+	except OSError:
+		return session['mr_id']
+	return matches[0] if len(matches) == 1 else session['mr_id']
+
+def session_gz_threads(jobs):
+	
+	# DESCRIPTION: default nifti compression threads per session when jobs sessions are converted in parallel on one node
+	
+	return max(1, (os.cpu_count() or 1) // max(1, jobs))
+
+def convert_session(session, logdir = None, options = None):
+	
+	# DESCRIPTION: convert a single session in a worker process; failures are reported instead of ending the batch
+	
+	result = dict(session)
+	result['status'] = 'failed'
+	result['message'] = ''
+	start = time.time()
+	
+	logfile = None
+	if logdir:
+		logfile = open(Path(logdir, '_'.join([session['project_id'], session['cimbi_id'], session['mr_id']]) + '.log'), 'w')
+	
+	def run():
+		s2r = Source2Raw(*[session[elem] for elem in inputvarList], **(options or {}))
+		s2r.run_all()
+		return s2r
+	
+	try:
+		if logfile:
+			with redirect_stdout(logfile), redirect_stderr(logfile):
+				s2r = run()
+		else:
+			s2r = run()
+		result['status'] = 'ok'
+		result['mr_id'] = s2r.inputvar['mr_id']
+		result['message'] = s2r.bidsinfo['sesfolder']
+		result['bytes'] = s2r.tracer.summary()['counters'].get('dcm2niix.bytes', 0)
+	except Source2RawError as e:
+		result['message'] = str(e)
+	except Exception as e:
+		result['message'] = '%s: %s' % (type(e).__name__, e)
+		if logfile:
+			traceback.print_exc(file = logfile)
+	finally:
+		if logfile:
+			logfile.close()
+	
+	result['duration'] = '%.1f' % (time.time() - start)
+	return result
+
+def run_batch(sessions, max_workers = None, logdir = None, options = None, scheduler = None):
+	
+	# DESCRIPTION: run all sessions on a bounded process pool and collect per-session results
+	# scheduler: IOScheduler deciding the order (fair share across source archives/projects, adaptive limits per filesystem)
+	
+	results = []
+	
+	# the same source session listed twice (also as different prefixes, e.g. p231 and p231sc) would be converted into the same
+	# session folder concurrently
+	mrsource = (options or {}).get('mrsource') or Source2Raw.mrsource
+	seen = set()
+	todo = []
+	for session in sessions:
+		key = (session['raw_id'], session['project_id'], resolved_mrid(session, mrsource))
+		if key in seen:
+			print('Duplicate manifest entry skipped: %s' % ' '.join([session[elem] for elem in inputvarList]))
+			results.append(dict(session, status = 'skipped', message = 'duplicate manifest entry', duration = '0.0'))
+			continue
+		seen.add(key)
+		todo.append(session)
+	
+	if logdir:
+		os.makedirs(logdir, exist_ok = True)
+	
+	max_workers = max_workers or os.cpu_count() or 1
+	if scheduler is None:
+		scheduler = io_scheduler.IOScheduler(max_workers, mrsource = mrsource)
+	for session in todo:
+		scheduler.add(session, 'backfill')
+	
+	# the scheduler starts at most max_workers sessions, so none wait in the pool (durations measure conversion only)
+	with ProcessPoolExecutor(max_workers = max_workers) as pool:
+		for n, result in enumerate(scheduler.run(pool, convert_session, logdir, options), start = 1):
+			print('[%s/%s] %s %s %s: %s' % (n, len(todo), result['status'].upper(), result['cimbi_id'], result['mr_id'], result['message']))
+			results.append(result)
+	
+	return results
+
+def export_participants(results):
+	
+	# DESCRIPTION: write participants.tsv once per project touched by the batch
+	
+	for projfolder in sorted(set([str(Path(elem['raw_id'], elem['project_id'])) for elem in results if elem['status'] != 'skipped'])):
+		if os.path.isdir(Path(projfolder, '.source2raw')):
+			registry = ParticipantsRegistry.for_project(projfolder)
+			registry.export_tsv(str(Path(projfolder, 'participants.tsv')))
+			registry.close()
+
+def write_report(results, fname):
+	
+	# DESCRIPTION: write per-session results to tsv
+	
+	column_set = inputvarList + ['status', 'duration', 'message']
+	with open(fname, 'w', newline = '') as f:
+		writer = csv.DictWriter(f, fieldnames = column_set, delimiter = '\t', extrasaction = 'ignore')
+		writer.writeheader()
+		writer.writerows(results)
+	print('Report written: %s' % fname)
+
+def merge_traces(trace_dir):
+	
+	# DESCRIPTION: combine per-session trace summaries into <trace_dir>/summary.json
+	
+	summaries = [read_json(str(Path(trace_dir, fname))) for fname in sorted(os.listdir(trace_dir)) if fname.endswith('.summary.json')]
+	fname = str(Path(trace_dir, 'summary.json'))
+	atomic_write_json(fname, merge_summaries(summaries), indent = 1)
+	print('Trace summary written: %s (%s sessions)' % (fname, len(summaries)))
+
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description = 'Convert many sessions listed in a manifest (columns: raw_id, project_id, cimbi_id, mr_id) to BIDS.')
+	parser.add_argument('manifest', help = 'csv/tsv file with one session per row')
+	parser.add_argument('-j', '--jobs', type = int, default = min(4, os.cpu_count() or 1), help = 'number of sessions converted in parallel')
+	parser.add_argument('--mrsource', default = Source2Raw.mrsource, help = 'MRraw folder with one subfolder per scanner')
+	parser.add_argument('--raw_id', help = 'raw folder used for all rows (overrides/replaces raw_id column)')
+	parser.add_argument('--logdir', help = 'write per-session output to <logdir>/<project_id>_<cimbi_id>_<mr_id>.log')
+	parser.add_argument('--report', help = 'write per-session results to this tsv file')
+	parser.add_argument('--series_jobs', type = int, default = 1, help = 'number of series converted in parallel within each session')
+	parser.add_argument('--gz_threads', type = int, help = 'threads for nifti compression per session (1: dcm2niix compresses; default: cpu count / jobs)')
+	parser.add_argument('--scratch', help = 'convert in this local folder and publish finished sessions to the raw folder')
+	parser.add_argument('--verify_cache', action = 'store_true', help = 'check DICOM contents and output sizes before reusing cached conversions')
+	parser.add_argument('--continue_on_error', action = 'store_true', help = 'skip series where dcm2niix fails instead of failing the session')
+	parser.add_argument('--trace', help = 'write JSON-lines events and summaries per session to this folder (merged into summary.json)')
+	parser.add_argument('--profile', default = '', help = 'comma separated stages/spans to run under cProfile, one at a time (profiles written to --trace folder)')
+	parser.add_argument('--profile_memory', action = 'store_true', help = 'also trace memory allocations of profiled stages')
+	parser.add_argument('--plan', help = 'dry run: convert into <folder>/staging and write the planned file operations of every session to this folder (check with session_plan.py); raw folders are not changed')
+	io_scheduler.add_arguments(parser)
+	args = parser.parse_args()
+	
+	options = {'d2n_workers': args.series_jobs, 'd2n_policy': 'continue' if args.continue_on_error else 'failfast', 'export_participants': False, 'mrsource': args.mrsource, 'scratch': args.scratch, 'gz_threads': args.gz_threads or session_gz_threads(args.jobs), 'cache_verify': args.verify_cache,
+			'trace_dir': args.trace, 'profile': [elem for elem in args.profile.split(',') if elem], 'profile_memory': args.profile_memory, 'plan_dir': args.plan}
+	if (options['profile'] or args.profile_memory) and not args.trace:
+		sys.exit('--profile and --profile_memory require --trace')
+	
+	sessions = read_manifest(args.manifest, args.raw_id)
+	print('%s sessions read from %s' % (len(sessions), args.manifest))
+	
+	try:
+		scheduler = io_scheduler.from_args(args, args.jobs, args.mrsource)
+	except ValueError as e:
+		sys.exit(str(e))
+	results = run_batch(sessions, max_workers = args.jobs, logdir = args.logdir, options = options, scheduler = scheduler)
+	scheduler.report()
+	if not args.plan:
+		export_participants(results)
+	if args.trace:
+		merge_traces(args.trace)
+	if args.report:
+		write_report(results, args.report)
+	
+	failed = [elem for elem in results if elem['status'] == 'failed']
+	print('Done! %s ok, %s failed, %s skipped' % (len([elem for elem in results if elem['status'] == 'ok']), len(failed), len([elem for elem in results if elem['status'] == 'skipped'])))
+	if failed:
+		sys.exit(1)
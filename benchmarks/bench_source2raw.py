@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import sys
+import csv
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import contextlib
+from pathlib import Path
+
+# source2raw modules live in the parent folder; keep the MRraw index cache of synthetic archives out of the user cache
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('NRUBIDS_CACHE', str(Path(tempfile.gettempdir(), 'bench_source2raw_cache')))
+
+from make_mrraw import make_archive
+from source2raw import Source2Raw
+
+fake_dcm2niix = str(Path(__file__).resolve().parent / 'fake_dcm2niix.py')
+stages = ['check_mrid', 'check_rawfolder', 'check_sesfolder', 'check_datafolder', 'check_workfolder', 'convert_source_inputs', 'process_dcmfolders', 'move_dcmfolders', 'publish_workfolder', 'update_conversion_cache', 'update_scan_index']
+
+def timed_session(rawfolder, mrsource, mr_id, cimbi_id, options):
+	
+	# DESCRIPTION: run_all for one session with every stage timed; returns {stage: seconds}
+	
+	timings = {}
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		s2r = Source2Raw(rawfolder, 'bench', cimbi_id, mr_id, mrsource = mrsource, d2n_path = fake_dcm2niix, **options)
+		
+		# instance attributes shadow the methods called by run_all
+		for stage in stages:
+			def timed(method = getattr(s2r, stage), stage = stage):
+				start = time.perf_counter()
+				try:
+					return method()
+				finally:
+					timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+			setattr(s2r, stage, timed)
+		
+		start = time.perf_counter()
+		s2r.run_all()
+		timings['total'] = time.perf_counter() - start
+	return timings
+
+def run_size(size, scale, args, workdir):
+	
+	# DESCRIPTION: generate an archive for one data size, convert each session (cold), then again (rerun: journal no-op); returns result rows
+	
+	dims = {'sessions': args.sessions, 'bold': args.bold, 'files': args.files}
+	dims[scale] = size
+	mrsource = str(Path(workdir, 'MRraw'))
+	rawfolder = str(Path(workdir, 'raw'))
+	mr_ids = make_archive(mrsource, dims['sessions'], dims['bold'], dims['files'], args.filesize, args.echoes)
+	options = {'d2n_workers': args.series_jobs, 'gz_threads': args.gz_threads, 'use_cache': not args.no_cache}
+	
+	rows = []
+	for repeat in range(args.repeat):
+		shutil.rmtree(rawfolder, ignore_errors = True)
+		for mode in ['cold', 'rerun']:
+			timings = {}
+			for k, mr_id in enumerate(mr_ids):
+				for stage, seconds in timed_session(rawfolder, mrsource, mr_id, str(10000 + k), options).items():
+					timings.setdefault(stage, []).append(seconds)
+			for stage, values in timings.items():
+				rows.append({'scale': scale, 'size': size, 'mode': mode, 'repeat': repeat, 'stage': stage, 'seconds': sum(values), 'per_session': statistics.median(values)})
+	shutil.rmtree(mrsource)
+	shutil.rmtree(rawfolder, ignore_errors = True)
+	return rows
+
+def summarize(rows):
+	
+	# DESCRIPTION: median over repeats per (mode, stage, size) and scaling exponent between smallest and largest size (1 = linear)
+	
+	medians = {}
+	for row in rows:
+		medians.setdefault((row['mode'], row['stage'], row['size']), []).append(row['seconds'])
+	medians = {key: statistics.median(val) for key, val in medians.items()}
+	sizes = sorted(set([key[2] for key in medians.keys()]))
+	
+	summary = []
+	for mode, stage in sorted(set([key[:2] for key in medians.keys()]), key = lambda elem: (elem[0], (stages + ['total']).index(elem[1]))):
+		curve = [medians[(mode, stage, size)] for size in sizes]
+		exponent = ''
+		if len(sizes) > 1 and curve[0] > 0 and curve[-1] > 0:
+			exponent = round(math.log(curve[-1] / curve[0]) / math.log(sizes[-1] / sizes[0]), 2)
+		summary.append({'mode': mode, 'stage': stage, 'curve': curve, 'exponent': exponent})
+	return sizes, medians, summary
+
+def compare_baseline(medians, scale, baseline, tolerance):
+	
+	# DESCRIPTION: stages slower than tolerance x baseline (tsv written by an earlier run with --out, same scaled dimension)
+	
+	regressions = []
+	with open(baseline, newline = '') as f:
+		reference = {}
+		for row in csv.DictReader(f, delimiter = '\t'):
+			if row['scale'] != scale:
+				continue
+			reference.setdefault((row['mode'], row['stage'], int(row['size'])), []).append(float(row['seconds']))
+	for key, seconds in medians.items():
+		if key in reference:
+			before = statistics.median(reference[key])
+			# ignore stages too short to time reliably
+			if seconds > tolerance * before and seconds - before > 0.05:
+				regressions.append((key, before, seconds))
+	return regressions
+
+if __name__ == '__main__':
+	
+	# e.g. python3 benchmarks/bench_source2raw.py --scale bold --sizes 2,4,8,16 --out bench.tsv
+	
+	parser = argparse.ArgumentParser(description = 'Time each run_all stage of source2raw on synthetic MRraw sessions across data sizes.')
+	parser.add_argument('--scale', choices = ['sessions', 'bold', 'files'], default = 'bold', help = 'dimension varied across sizes')
+	parser.add_argument('--sizes', default = '2,4,8', help = 'comma separated sizes of the scaled dimension')
+	parser.add_argument('--sessions', type = int, default = 1, help = 'sessions per size (unless scaled)')
+	parser.add_argument('--bold', type = int, default = 2, help = 'resting state runs per session (unless scaled)')
+	parser.add_argument('--files', type = int, default = 10, help = 'DICOM files per series (unless scaled)')
+	parser.add_argument('--filesize', type = int, default = 1024, help = 'bytes per DICOM file')
+	parser.add_argument('--echoes', type = int, default = 2, help = 'field map magnitude echoes')
+	parser.add_argument('--repeat', type = int, default = 3)
+	parser.add_argument('--delay', type = float, default = 0.05, help = 'fake dcm2niix seconds per series')
+	parser.add_argument('--delay_per_file', type = float, default = 0.001, help = 'fake dcm2niix seconds per DICOM file')
+	parser.add_argument('--nii_bytes', type = int, default = 1024 * 1024, help = 'fake dcm2niix voxel bytes per image')
+	parser.add_argument('--series_jobs', type = int, default = min(4, os.cpu_count() or 1))
+	parser.add_argument('--gz_threads', type = int, default = os.cpu_count() or 1)
+	parser.add_argument('--no_cache', action = 'store_true', help = 'disable conversion cache')
+	parser.add_argument('--workdir', help = 'folder for synthetic archive and raw tree (default: temporary folder)')
+	parser.add_argument('--out', help = 'write all timings to this tsv (usable as --baseline later)')
+	parser.add_argument('--baseline', help = 'tsv of an earlier run; exit with an error if a stage got slower')
+	parser.add_argument('--tolerance', type = float, default = 1.5, help = 'allowed slowdown factor against baseline')
+	args = parser.parse_args()
+	
+	os.environ['FAKE_D2N_DELAY'] = str(args.delay)
+	os.environ['FAKE_D2N_DELAY_PER_FILE'] = str(args.delay_per_file)
+	os.environ['FAKE_D2N_NII_BYTES'] = str(args.nii_bytes)
+	
+	workdir = args.workdir or tempfile.mkdtemp(prefix = 'bench_source2raw_')
+	os.makedirs(workdir, exist_ok = True)
+	
+	rows = []
+	try:
+		for size in [int(elem) for elem in args.sizes.split(',')]:
+			print('Benchmarking %s = %s...' % (args.scale, size))
+			rows.extend(run_size(size, args.scale, args, workdir))
+	finally:
+		if not args.workdir:
+			shutil.rmtree(workdir, ignore_errors = True)
+	
+	sizes, medians, summary = summarize(rows)
+	print('\n%-8s %-24s %s %10s' % ('mode', 'stage', ' '.join(['%9s' % ('%s=%s' % (args.scale[0], size)) for size in sizes]), 'exponent'))
+	for elem in summary:
+		print('%-8s %-24s %s %10s' % (elem['mode'], elem['stage'], ' '.join(['%8.3fs' % val for val in elem['curve']]), elem['exponent']))
+	
+	if args.out:
+		with open(args.out, 'w', newline = '') as f:
+			writer = csv.DictWriter(f, fieldnames = ['scale', 'size', 'mode', 'repeat', 'stage', 'seconds', 'per_session'], delimiter = '\t', lineterminator = '\n')
+			writer.writeheader()
+			writer.writerows(rows)
+		print('%s written!' % args.out)
+	
+	if args.baseline:
+		regressions = compare_baseline(medians, args.scale, args.baseline, args.tolerance)
+		for (mode, stage, size), before, seconds in regressions:
+			print('REGRESSION %s %s size %s: %.3f s -> %.3f s' % (mode, stage, size, before, seconds))
+		if regressions:
+			sys.exit('%s stages slower than %s x baseline' % (len(regressions), args.tolerance))
+		print('No regressions against %s' % args.baseline)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import sys
+import json
+import time
+import gzip
+import struct
+from pathlib import Path
+
+from make_mrraw import metafile
+
+# controlled delays and output size (environment, so source2raw can call this like dcm2niix)
+delay = float(os.environ.get('FAKE_D2N_DELAY', '0.05')) # seconds per series
+delay_per_file = float(os.environ.get('FAKE_D2N_DELAY_PER_FILE', '0.001')) # seconds per DICOM file
+nii_bytes = int(os.environ.get('FAKE_D2N_NII_BYTES', str(1024 * 1024))) # voxel data per image
+
+def nifti_header(nbytes):
+	
+	# DESCRIPTION: minimal NIfTI-1 header (348 bytes + 4 byte extension flag) for a 3D int16 image of about nbytes
+	
+	nx = 64
+	nz = max(1, nbytes // (nx * nx * 2))
+	hdr = bytearray(348)
+	struct.pack_into('<i', hdr, 0, 348)
+	struct.pack_into('<8h', hdr, 40, 3, nx, nx, nz, 1, 1, 1, 1)
+	struct.pack_into('<hh', hdr, 70, 4, 16) # datatype int16, bitpix
+	struct.pack_into('<8f', hdr, 76, 1, 2, 2, 2, 0, 0, 0, 0)
+	struct.pack_into('<f', hdr, 108, 352) # vox_offset
+	struct.pack_into('<f', hdr, 112, 1) # scl_slope
+	hdr[344:348] = b'n+1\0'
+	return bytes(hdr) + b'\0' * 4, nx * nx * nz * 2
+
+if __name__ == '__main__':
+	
+	# same arguments as dcm2niix as called by source2raw: -o <outfolder> -z <y|n> -f <filename> <dicomfolder>
+	
+	argumentList = sys.argv[1:]
+	outfolder = argumentList[argumentList.index('-o') + 1]
+	compress = argumentList[argumentList.index('-z') + 1] == 'y'
+	filename = argumentList[argumentList.index('-f') + 1]
+	dcmfolder = argumentList[-1]
+	
+	if not os.path.exists(Path(dcmfolder, metafile)):
+		sys.exit('No DICOM files found in %s' % dcmfolder)
+	with open(Path(dcmfolder, metafile)) as f:
+		images = json.load(f)
+	nfiles = len([fname for fname in os.listdir(dcmfolder) if fname.endswith('.dcm')])
+	time.sleep(delay + delay_per_file * nfiles)
+	
+	header, nvoxbytes = nifti_header(nii_bytes)
+	for image in images:
+		outname = str(Path(outfolder, filename + image.get('postfix', '')))
+		with open(outname + '.json', 'w') as f:
+			json.dump({key: val for key, val in image.items() if key != 'postfix'}, f, indent = 1)
+		with (gzip.open(outname + '.nii.gz', 'wb', compresslevel = 6) if compress else open(outname + '.nii', 'wb')) as f:
+			f.write(header)
+			f.write(os.urandom(nvoxbytes // 4) * 4)
+		print('Convert %s DICOM as %s (64x64x%sx1)' % (nfiles, outname, nvoxbytes // (64 * 64 * 2)))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import json
+import argparse
+from pathlib import Path
+
+# outputs of each series are described in this file, read by fake_dcm2niix.py instead of DICOM headers
+metafile = 'fake_dcm2niix.json'
+
+def series_outputs(name, kind, hour, minute, echoes):
+	
+	# DESCRIPTION: sidecar fields of the images dcm2niix would write for a series (one dict per image, postfix as dcm2niix)
+	# field map ImageType as written by the prisma: magnitude images NORM, phase difference P (dcm2niix adds PHASE)
+	
+	acqtime = '%02d:%02d:00.000000' % (hour + minute // 60, minute % 60)
+	image = {'SeriesDescription': name, 'AcquisitionTime': acqtime, 'ImageType': ['ORIGINAL', 'PRIMARY', 'M', 'ND']}
+	if kind == 'phase':
+		return [dict(image, postfix = '_e2_ph', EchoNumber = 2, ImageType = ['ORIGINAL', 'PRIMARY', 'P', 'ND', 'PHASE'])]
+	if kind == 'magnitude':
+		return [dict(image, postfix = '_e%s' % e, EchoNumber = e, ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND', 'NORM']) for e in range(1, echoes + 1)]
+	if kind == 'distortion_corrected':
+		return [dict(image, ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'DIS2D'])]
+	return [image]
+
+def session_series(nbold):
+	
+	# DESCRIPTION: (series folder, name, kind) of one session in acquisition order, as on the prisma: anatomy, field map, nbold resting state runs, task, diffusion
+	
+	series = [('T1_MPRAGE', 'image'), ('T1_MPRAGE', 'distortion_corrected'), ('GRE_FIELD_MAPPING', 'magnitude'), ('GRE_FIELD_MAPPING', 'phase')]
+	series += [('EP2D_REST', 'image')] * nbold + [('EP2D_FACES', 'image'), ('EP2D_DIFF', 'image')]
+	return [('%s_%04d' % (name, i + 2), name, kind) for i, (name, kind) in enumerate(series)]
+
+def make_session(scannerfolder, mr_id, nbold = 2, nfiles = 10, filesize = 1024, echoes = 2, hour = 9):
+	
+	# DESCRIPTION: one synthetic session folder: series folders with nfiles dummy DICOM files of filesize bytes each
+	
+	sessionfolder = Path(scannerfolder, mr_id)
+	payload = os.urandom(filesize)
+	for i, (folder, name, kind) in enumerate(session_series(nbold)):
+		seriesfolder = Path(sessionfolder, folder)
+		os.makedirs(seriesfolder, exist_ok = True)
+		with open(Path(seriesfolder, metafile), 'w') as f:
+			json.dump(series_outputs(name, kind, hour, 5 * i, echoes), f)
+		for j in range(nfiles):
+			with open(Path(seriesfolder, 'MR.%s.%04d.dcm' % (folder, j + 1)), 'wb') as f:
+				f.write(payload)
+	return str(sessionfolder)
+
+def make_archive(mrsource, nsessions = 1, nbold = 2, nfiles = 10, filesize = 1024, echoes = 2, scanner = 'prisma', prefix = 'p'):
+	
+	# DESCRIPTION: synthetic MRraw archive (<mrsource>/<scanner>/<mr_id>/<series>); returns list of mr_ids
+	
+	mr_ids = []
+	for k in range(nsessions):
+		mr_id = '%s%03dbm_2026' % (prefix, k + 1)
+		make_session(Path(mrsource, scanner), mr_id, nbold = nbold, nfiles = nfiles, filesize = filesize, echoes = echoes, hour = 8 + k % 10)
+		mr_ids.append(mr_id)
+	return mr_ids
+
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description = 'Generate a synthetic MRraw archive for benchmarking source2raw.')
+	parser.add_argument('mrsource', help = 'output folder (one subfolder per scanner)')
+	parser.add_argument('--sessions', type = int, default = 1)
+	parser.add_argument('--bold', type = int, default = 2, help = 'resting state runs per session')
+	parser.add_argument('--files', type = int, default = 10, help = 'DICOM files per series')
+	parser.add_argument('--filesize', type = int, default = 1024, help = 'bytes per DICOM file')
+	parser.add_argument('--echoes', type = int, default = 2, help = 'echoes of the field map magnitude series')
+	args = parser.parse_args()
+	
+	mr_ids = make_archive(args.mrsource, args.sessions, args.bold, args.files, args.filesize, args.echoes)
+	print('%s sessions written to %s' % (len(mr_ids), Path(args.mrsource, 'prisma')))
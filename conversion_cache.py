@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import time
+import json
+import hashlib
+import sqlite3
+from pathlib import Path
+
+def series_fingerprint(seriesFolder):
+	
+	# DESCRIPTION: cheap fingerprint of a DICOM series folder from one scandir pass: file count, total size and a hash of (name, size, mtime)
+	
+	entries = []
+	with os.scandir(seriesFolder) as it:
+		for entry in it:
+			if entry.is_file():
+				st = entry.stat()
+				entries.append((entry.name, st.st_size, st.st_mtime_ns))
+	entries.sort()
+	digest = hashlib.sha1(repr(entries).encode()).hexdigest()
+	return '%s:%s:%s' % (len(entries), sum([elem[1] for elem in entries]), digest[:16])
+
+def series_content_hash(seriesFolder, nbytes = 4096):
+	
+	# DESCRIPTION: stronger check used in verify mode: hash of the first and last bytes of every DICOM file
+	
+	h = hashlib.sha1()
+	for fname in sorted(os.listdir(seriesFolder)):
+		fullpath = os.path.join(seriesFolder, fname)
+		if not os.path.isfile(fullpath):
+			continue
+		with open(fullpath, 'rb') as f:
+			h.update(fname.encode())
+			h.update(f.read(nbytes))
+			size = os.fstat(f.fileno()).st_size
+			if size > nbytes:
+				f.seek(max(nbytes, size - nbytes))
+				h.update(f.read(nbytes))
+	return h.hexdigest()
+
+class ConversionCache():
+	
+	def __init__(self, dbfile, projfolder, max_entries = 100000, readonly = False):
+		
+		# DESCRIPTION: conversion results per source series, keyed by SeriesInstanceUID + fingerprint of the DICOM files
+		# outputs are stored relative to the project folder; least recently used entries are evicted beyond max_entries
+		# readonly (dry run): open an existing cache without changing it (no last_used updates or removals)
+		
+		self.dbfile = str(dbfile)
+		self.projfolder = str(projfolder)
+		self.max_entries = max_entries
+		self.readonly = readonly
+		if readonly:
+			self.conn = sqlite3.connect('%s?mode=ro' % Path(self.dbfile).resolve().as_uri(), uri = True, timeout = 300, isolation_level = None)
+			return
+		os.makedirs(os.path.dirname(self.dbfile), exist_ok = True)
+		self.conn = sqlite3.connect(self.dbfile, timeout = 300, isolation_level = None)
+		self.conn.execute('CREATE TABLE IF NOT EXISTS series (key TEXT PRIMARY KEY, series TEXT, sesfolder TEXT, content TEXT, outputs TEXT, last_used REAL)')
+		self.conn.execute('CREATE INDEX IF NOT EXISTS series_last_used ON series (last_used)')
+	
+	@classmethod
+	def for_project(cls, projfolder, max_entries = 100000, readonly = False):
+		
+		return cls(cls.project_dbfile(projfolder), projfolder, max_entries, readonly)
+	
+	@staticmethod
+	def project_dbfile(projfolder):
+		
+		return Path(projfolder, '.source2raw', 'conversion_cache.sqlite')
+	
+	@staticmethod
+	def make_key(uid, fingerprint):
+		
+		return '%s|%s' % (uid, fingerprint)
+	
+	def relpath(self, fullpath):
+		
+		return os.path.relpath(fullpath, self.projfolder)
+	
+	def abspath(self, relpath):
+		
+		return str(Path(self.projfolder, relpath))
+	
+	def lookup(self, key, sesfolder, seriesFolder = None, verify = False):
+		
+		# DESCRIPTION: cached outputs {elem: sourcefile entry} for key, or None
+		# a hit requires all outputs to still exist in the same session folder; verify also checks output sizes and DICOM content
+		
+		row = self.conn.execute('SELECT sesfolder, content, outputs FROM series WHERE key = ?', (key,)).fetchone()
+		if row is None or row[0] != self.relpath(sesfolder):
+			return None
+		outputs = json.loads(row[2])
+		for elem, entry in outputs.items():
+			for name in ['newjson', 'newnii']:
+				if name not in entry:
+					continue
+				entry[name] = self.abspath(entry[name])
+				if not os.path.exists(entry[name]):
+					return None
+				if verify and os.path.getsize(entry[name]) != entry['sizes'][name]:
+					print('Cached output changed: %s' % entry[name])
+					if not self.readonly:
+						self.remove(key)
+					return None
+		if verify and seriesFolder and row[1] and row[1] != series_content_hash(seriesFolder):
+			print('Source series changed: %s' % seriesFolder)
+			if not self.readonly:
+				self.remove(key)
+			return None
+		if not self.readonly:
+			self.conn.execute('UPDATE series SET last_used = ? WHERE key = ?', (time.time(), key))
+		return outputs
+	
+	def store(self, key, series, sesfolder, outputs, content = None):
+		
+		# DESCRIPTION: record outputs of a converted series (entries of removed images are kept, so they are not reconverted either)
+		# content: series_content_hash of the DICOM files, stored for verify mode
+		
+		outputs = {elem: dict(entry) for elem, entry in outputs.items()}
+		for entry in outputs.values():
+			entry['sizes'] = {}
+			for name in ['newjson', 'newnii']:
+				if name in entry:
+					entry['sizes'][name] = os.path.getsize(entry[name])
+					entry[name] = self.relpath(entry[name])
+		self.conn.execute('INSERT OR REPLACE INTO series (key, series, sesfolder, content, outputs, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+				(key, series, self.relpath(sesfolder), content, json.dumps(outputs), time.time()))
+	
+	def remove(self, key):
+		
+		self.conn.execute('DELETE FROM series WHERE key = ?', (key,))
+	
+	def evict(self):
+		
+		# DESCRIPTION: keep the max_entries most recently used entries
+		
+		n = self.conn.execute('SELECT COUNT(*) FROM series').fetchone()[0]
+		if n > self.max_entries:
+			self.conn.execute('DELETE FROM series WHERE key IN (SELECT key FROM series ORDER BY last_used LIMIT ?)', (n - self.max_entries,))
+			print('Conversion cache: %s entries evicted' % (n - self.max_entries))
+	
+	def close(self):
+		
+		self.conn.close()
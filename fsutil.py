@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import json
+import stat
+import tempfile
+
+# permissions of new files (mkstemp makes them 0600, which other users of the raw tree cannot read)
+umask = os.umask(0)
+os.umask(umask)
+
+def atomic_write_text(fname, text, fsync = False):
+	
+	# DESCRIPTION: write file via temporary file in the same folder + os.replace, so readers never see a partial file
+	# the file keeps the mode of the file it replaces (new files: 0666 minus umask, as open() would make them)
+	
+	fname = str(fname)
+	try:
+		mode = stat.S_IMODE(os.stat(fname).st_mode)
+	except FileNotFoundError:
+		mode = 0o666 & ~umask
+	fd, tmpname = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(fname)), prefix = '.' + os.path.basename(fname) + '.', suffix = '.tmp')
+	try:
+		os.fchmod(fd, mode)
+		with os.fdopen(fd, 'w') as f:
+			f.write(text)
+			if fsync:
+				f.flush()
+				os.fsync(f.fileno())
+		os.replace(tmpname, fname)
+	except BaseException:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+	
+def atomic_write_json(fname, data, indent = None, fsync = False):
+	
+	# DESCRIPTION: json.dumps + atomic_write_text
+	
+	atomic_write_text(fname, json.dumps(data, indent = indent), fsync = fsync)
+	
+def read_json(fname, default = None):
+	
+	# DESCRIPTION: load json file, default if missing or unreadable (e.g., truncated by a crash)
+	
+	try:
+		with open(fname) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return default
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import time
+from pathlib import Path
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from source2raw import Source2Raw
+
+# lower runs first: sessions that just landed on a scanner go before conversions of old sessions
+priorities = {'prospective': 0, 'backfill': 1}
+
+def filesystem_id(path):
+	
+	# DESCRIPTION: device of the filesystem holding path (nearest existing parent), so folders on the same storage share a queue
+	
+	path = os.path.abspath(str(path))
+	while not os.path.exists(path) and os.path.dirname(path) != path:
+		path = os.path.dirname(path)
+	try:
+		return os.stat(path).st_dev
+	except OSError:
+		return path
+
+class Throttle():
+	
+	def __init__(self, name, cap, adaptive = True, alpha = 1, beta = 2, decay = 0.98):
+		
+		# DESCRIPTION: concurrency limit of one filesystem, between 1 and cap; adaptive: AIMD on measured session throughput
+		# baseline: best recent throughput of a single session; if sessions run much slower than that, the filesystem is saturated:
+		# backlog = concurrency * (1 - rate / baseline) (sessions' worth of waiting); above beta halve the limit, below alpha add one
+		# only sessions started since the last change count (one step per round of sessions, not one per finished session)
+		
+		self.name = name
+		self.cap = max(1, cap)
+		self.adaptive = adaptive
+		self.alpha = alpha
+		self.beta = beta
+		self.decay = decay
+		self.limit = float(min(self.cap, 2) if adaptive else self.cap)
+		self.baseline = 0
+		self.epoch = 0
+		self.running = []
+	
+	def slots(self):
+		
+		return max(1, int(self.limit))
+	
+	def free(self):
+		
+		return len(self.running) < self.slots()
+	
+	def start(self, task):
+		
+		self.running.append(task)
+		task['epoch'][self.name] = self.epoch
+		for elem in self.running:
+			elem['concurrency'][self.name] = max(elem['concurrency'].get(self.name, 0), len(self.running))
+	
+	def finish(self, task, nbytes, seconds):
+		
+		self.running.remove(task)
+		
+		# cached or failed sessions move no data, nothing to learn from
+		if not self.adaptive or nbytes <= 0 or seconds <= 0:
+			return
+		rate = nbytes / seconds
+		self.baseline = max(rate, self.baseline * self.decay)
+		if task['epoch'][self.name] != self.epoch:
+			return
+		concurrency = task['concurrency'][self.name]
+		backlog = concurrency * (1 - rate / self.baseline)
+		if backlog > self.beta and self.limit > 1:
+			self.limit = max(1.0, self.limit / 2)
+			self.epoch += 1
+			print('Throttling %s: %.1f MB/s per session at %s concurrent (best %.1f MB/s), limit %s' % (self.name, rate / 1e6, concurrency, self.baseline / 1e6, self.slots()))
+		elif backlog < self.alpha and concurrency >= self.slots() and self.limit < self.cap:
+			self.limit = min(float(self.cap), self.limit + 1)
+			self.epoch += 1
+	
+	def state(self):
+		
+		return {'limit': self.limit, 'baseline': self.baseline}
+	
+	def restore(self, state):
+		
+		if self.adaptive and state:
+			self.limit = min(float(self.cap), max(1.0, state.get('limit', self.limit)))
+			self.baseline = state.get('baseline', 0)
+
+class IOScheduler():
+	
+	def __init__(self, max_running = 4, source_cap = None, dest_cap = None, project_cap = None, fs_caps = None, adaptive = True, mrsource = Source2Raw.mrsource, scanners = Source2Raw.mrscanners):
+		
+		# DESCRIPTION: decide which queued sessions to convert next; sessions are queued per priority, source filesystem (scanner archive),
+		# destination filesystem (raw folder) and project, and started only if all of them have a free slot
+		# source_cap/dest_cap: maximum concurrent sessions per filesystem (default max_running); fs_caps: {folder: cap} for specific ones
+		# project_cap: maximum concurrent sessions per project (None: no limit); adaptive: lower/raise filesystem limits on measured throughput
+		# among startable sessions the highest priority wins, then the filesystem and project with the fewest running sessions (fair share)
+		# caps below 1 would never let a session start: ValueError
+		
+		for name, cap in [('max_running', max_running), ('source_cap', source_cap), ('dest_cap', dest_cap), ('project_cap', project_cap)] + [('fs_cap %s' % key, val) for key, val in (fs_caps or {}).items()]:
+			if cap is not None and cap < 1:
+				raise ValueError('%s must be at least 1: %s' % (name, cap))
+		self.max_running = max_running
+		self.source_cap = source_cap or max_running
+		self.dest_cap = dest_cap or max_running
+		self.project_cap = project_cap
+		self.fs_caps = {filesystem_id(key): val for key, val in (fs_caps or {}).items()}
+		self.adaptive = adaptive
+		self.mrsource = mrsource
+		self.scanners = scanners
+		self.throttles = {}
+		self.saved = {}
+		self.queues = {}
+		self.projects = {}
+		self.running = 0
+		self.seq = 0
+	
+	def throttle(self, folder, kind):
+		
+		# DESCRIPTION: throttle of the filesystem holding folder (one per filesystem, named after the first folder seen on it)
+		
+		fsid = filesystem_id(folder)
+		if fsid not in self.throttles:
+			cap = self.fs_caps.get(fsid, self.source_cap if kind == 'source' else self.dest_cap)
+			self.throttles[fsid] = Throttle('%s:%s' % (kind, folder), cap, self.adaptive)
+			self.throttles[fsid].restore(self.saved.get(self.throttles[fsid].name))
+		return self.throttles[fsid]
+	
+	def add(self, session, priority = 'backfill', mrsource = None):
+		
+		# DESCRIPTION: queue a session (dict with raw_id, project_id, cimbi_id, mr_id); returns its task
+		
+		scanner = self.scanners.get(session['mr_id'][:1], '')
+		task = {
+				'session': session,
+				'priority': priorities.get(priority, priority),
+				'source': self.throttle(Path(mrsource or self.mrsource, scanner), 'source'),
+				'dest': self.throttle(session['raw_id'], 'dest'),
+				'project': str(Path(session['raw_id'], session['project_id'])),
+				'seq': self.seq,
+				'concurrency': {},
+				'epoch': {}}
+		self.seq += 1
+		if task['source'] is task['dest']:
+			task['dest'] = None # source and raw folder on the same filesystem: one limit
+		key = (task['priority'], task['source'].name, task['dest'].name if task['dest'] else '', task['project'])
+		self.queues.setdefault(key, []).append(task)
+		return task
+	
+	def pending(self):
+		
+		return sum([len(queue) for queue in self.queues.values()])
+	
+	def startable(self, task):
+		
+		if not task['source'].free() or (task['dest'] is not None and not task['dest'].free()):
+			return False
+		return self.project_cap is None or self.projects.get(task['project'], 0) < self.project_cap
+	
+	def next(self):
+		
+		# DESCRIPTION: start and return the next session to convert, None if nothing may start now
+		
+		if self.running >= self.max_running:
+			return None
+		candidates = [queue[0] for queue in self.queues.values() if queue and self.startable(queue[0])]
+		if not candidates:
+			return None
+		task = min(candidates, key = lambda elem: (elem['priority'], len(elem['source'].running) / elem['source'].slots(), self.projects.get(elem['project'], 0), elem['seq']))
+		key = (task['priority'], task['source'].name, task['dest'].name if task['dest'] else '', task['project'])
+		self.queues[key].pop(0)
+		if not self.queues[key]:
+			del self.queues[key]
+		
+		self.running += 1
+		self.projects[task['project']] = self.projects.get(task['project'], 0) + 1
+		for throttle in [task['source'], task['dest']]:
+			if throttle is not None:
+				throttle.start(task)
+		task['start'] = time.time()
+		return task
+	
+	def finish(self, task, result):
+		
+		# DESCRIPTION: release the slots of a finished session and feed its throughput (result bytes, duration) to the throttles
+		
+		self.running -= 1
+		self.projects[task['project']] -= 1
+		try:
+			seconds = float(result.get('duration') or 0)
+		except ValueError:
+			seconds = 0
+		seconds = seconds or time.time() - task['start']
+		nbytes = result.get('bytes', 0) if result.get('status') == 'ok' else 0
+		for throttle in [task['source'], task['dest']]:
+			if throttle is not None:
+				throttle.finish(task, nbytes, seconds)
+	
+	def dispatch(self, pool, fn, *args):
+		
+		# DESCRIPTION: submit fn(session, *args) for every session that may start now; returns {future: task}
+		
+		futures = {}
+		while True:
+			task = self.next()
+			if task is None:
+				return futures
+			futures[pool.submit(fn, task['session'], *args)] = task
+	
+	def run(self, pool, fn, *args):
+		
+		# DESCRIPTION: convert all queued sessions on pool, yielding results as they finish (a crashed worker yields a failed result)
+		
+		futures = self.dispatch(pool, fn, *args)
+		while futures:
+			done, notdone = wait(futures, return_when = FIRST_COMPLETED)
+			for future in done:
+				task = futures.pop(future)
+				try:
+					result = future.result()
+				except Exception as e:
+					result = dict(task['session'], status = 'failed', message = '%s: %s' % (type(e).__name__, e), duration = '')
+				self.finish(task, result)
+				yield result
+			futures.update(self.dispatch(pool, fn, *args))
+		if self.pending():
+			raise RuntimeError('%s sessions queued but never started' % self.pending())
+	
+	def state(self):
+		
+		# DESCRIPTION: learned limits per filesystem (e.g. kept in the watch state file, so cron runs continue where the last one stopped)
+		
+		return dict(self.saved, **{throttle.name: throttle.state() for throttle in self.throttles.values()})
+	
+	def restore(self, state):
+		
+		self.saved = dict(state or {})
+		for throttle in self.throttles.values():
+			throttle.restore(self.saved.get(throttle.name))
+	
+	def report(self):
+		
+		for throttle in sorted(self.throttles.values(), key = lambda elem: elem.name):
+			print('%s: limit %s of %s%s' % (throttle.name, throttle.slots(), throttle.cap, ', best %.1f MB/s per session' % (throttle.baseline / 1e6) if throttle.baseline else ''))
+
+def add_arguments(parser):
+	
+	# DESCRIPTION: scheduler options shared by batch and watch
+	
+	parser.add_argument('--source_cap', type = int, help = 'maximum sessions reading from one source filesystem at once (default: --jobs)')
+	parser.add_argument('--dest_cap', type = int, help = 'maximum sessions writing to one raw filesystem at once (default: --jobs)')
+	parser.add_argument('--project_cap', type = int, help = 'maximum sessions of one project converted at once (default: no limit)')
+	parser.add_argument('--fs_cap', action = 'append', default = [], metavar = 'FOLDER=N', help = 'cap for the filesystem holding FOLDER (repeatable), e.g. /rawdata/mr-rh/MRraw/mmr=1')
+	parser.add_argument('--no_adaptive', action = 'store_true', help = 'use the caps as fixed limits instead of adapting to measured throughput')
+
+def from_args(args, max_running, mrsource):
+	
+	fs_caps = {}
+	for elem in args.fs_cap:
+		folder, sep, cap = elem.rpartition('=')
+		if not sep or not cap.isdigit():
+			raise ValueError('--fs_cap expects FOLDER=N: %s' % elem)
+		fs_caps[folder] = int(cap)
+	return IOScheduler(max_running, source_cap = args.source_cap, dest_cap = args.dest_cap, project_cap = args.project_cap, fs_caps = fs_caps, adaptive = not args.no_adaptive, mrsource = mrsource)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+class LeaseBusy(Exception):
+	
+	# raised when a lease is held by someone else (and not expired) after waiting
+	pass
+
+class Lease():
+	
+	def __init__(self, fname, ttl = 120, owner = None):
+		
+		# DESCRIPTION: exclusive lease on a shared filesystem: a lease file created with O_EXCL (atomic on local disks and NFS)
+		# the holder refreshes the file mtime (heartbeat); a lease not refreshed for ttl seconds is expired and can be taken over
+		
+		self.fname = str(fname)
+		self.ttl = ttl
+		self.owner = owner or '%s:%s:%s' % (socket.gethostname(), os.getpid(), threading.get_ident())
+		self.held = False
+	
+	def try_acquire(self):
+		
+		# DESCRIPTION: take the lease if free or expired; returns True if held
+		
+		os.makedirs(os.path.dirname(os.path.abspath(self.fname)), exist_ok = True)
+		for attempt in range(2):
+			try:
+				fd = os.open(self.fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+			except FileExistsError:
+				if attempt == 0 and self.steal_expired():
+					continue
+				return False
+			with os.fdopen(fd, 'w') as f:
+				json.dump({'owner': self.owner, 'acquired': time.time()}, f)
+			self.held = True
+			return True
+		return False
+	
+	def steal_expired(self):
+		
+		# DESCRIPTION: move an expired lease aside; rename is atomic, so only one of several contenders succeeds
+		
+		try:
+			age = time.time() - os.stat(self.fname).st_mtime
+		except FileNotFoundError:
+			return True # released meanwhile
+		if age < self.ttl:
+			return False
+		stale = '%s.expired.%s' % (self.fname, self.owner.replace(':', '_'))
+		try:
+			os.rename(self.fname, stale)
+		except FileNotFoundError:
+			return True # someone else moved it first
+		
+		# a contender may have replaced the expired lease between stat and rename: put a fresh lease back (link fails if taken meanwhile)
+		if time.time() - os.stat(stale).st_mtime < self.ttl:
+			try:
+				os.link(stale, self.fname)
+			except FileExistsError:
+				pass
+			os.remove(stale)
+			return False
+		print('Lease expired (%.0f s without heartbeat), taken over: %s' % (age, self.fname))
+		os.remove(stale)
+		return True
+	
+	def acquire(self, wait = None, poll = 2):
+		
+		# DESCRIPTION: wait (seconds, None: forever) until the lease is free; raises LeaseBusy on timeout
+		
+		start = time.time()
+		while not self.try_acquire():
+			if wait is not None and time.time() - start >= wait:
+				raise LeaseBusy('%s held by %s' % (self.fname, self.holder()))
+			time.sleep(poll)
+	
+	def holder(self):
+		
+		try:
+			with open(self.fname) as f:
+				return json.load(f).get('owner')
+		except (OSError, ValueError):
+			return None
+	
+	def check(self):
+		
+		# DESCRIPTION: whether the lease is still ours (not expired and taken over while we were stalled); reads the lease file
+		
+		if self.held and self.holder() != self.owner:
+			self.held = False
+		return self.held
+	
+	def heartbeat(self):
+		
+		# DESCRIPTION: refresh the lease; returns False if it was lost (expired and taken over by someone else)
+		
+		if not self.held:
+			return False
+		if self.holder() != self.owner:
+			self.held = False
+			return False
+		os.utime(self.fname)
+		return True
+	
+	def release(self):
+		
+		if self.held and self.holder() == self.owner:
+			os.remove(self.fname)
+		self.held = False
+
+class Heartbeat():
+	
+	def __init__(self, interval = 30):
+		
+		# DESCRIPTION: background thread refreshing all registered leases every interval seconds (well below their ttl)
+		# lost: leases found taken over by someone else (no longer refreshed)
+		
+		self.interval = interval
+		self.leases = set()
+		self.lost = []
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target = self.run, daemon = True)
+		self.thread.start()
+	
+	def add(self, lease):
+		
+		with self.lock:
+			self.leases.add(lease)
+	
+	def discard(self, lease):
+		
+		with self.lock:
+			self.leases.discard(lease)
+	
+	def run(self):
+		
+		while not self.stopped.wait(self.interval):
+			with self.lock:
+				leases = list(self.leases)
+			for lease in leases:
+				try:
+					alive = lease.heartbeat()
+				except OSError as e:
+					print('Heartbeat failed for %s: %s' % (lease.fname, e))
+					continue
+				if not alive:
+					print('Lease lost: %s' % lease.fname)
+					self.lost.append(lease)
+					self.discard(lease)
+	
+	def stop(self):
+		
+		self.stopped.set()
+		self.thread.join()
+
+@contextmanager
+def hold(fname, ttl = 120, wait = None, poll = 2, heartbeat = None):
+	
+	# DESCRIPTION: hold a lease for the duration of a block, kept alive by heartbeat (a shared Heartbeat thread) if given
+	
+	# without heartbeat, a Heartbeat thread refreshing this lease only is started (every ttl/4 seconds)
+	
+	lease = Lease(fname, ttl)
+	lease.acquire(wait = wait, poll = poll)
+	own = heartbeat is None
+	if own:
+		heartbeat = Heartbeat(interval = ttl / 4)
+	heartbeat.add(lease)
+	try:
+		yield lease
+	finally:
+		heartbeat.discard(lease)
+		if own:
+			heartbeat.stop()
+		lease.release()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import time
+import hashlib
+from bisect import bisect_left
+from pathlib import Path
+
+from fsutil import atomic_write_json, read_json
+
+# on-disk index location (shared between runs, override with NRUBIDS_CACHE)
+default_cachedir = os.environ.get('NRUBIDS_CACHE', str(Path(os.path.expanduser('~'), '.cache', 'nrubids')))
+
+# indexes already loaded in this process (reused by batch runs)
+loaded = {}
+
+class MRrawIndex():
+	
+	def __init__(self, scannerfolder, cachedir = default_cachedir):
+		
+		# DESCRIPTION: sorted list of source sessions in a scanner folder (e.g. /rawdata/mr-rh/MRraw/prisma), persisted on disk
+		# the index is rebuilt only when the folder mtime changes (new/removed sessions)
+		
+		self.folder = str(scannerfolder)
+		tag = hashlib.sha1(os.path.abspath(self.folder).encode()).hexdigest()[:8]
+		self.cachefile = str(Path(cachedir, 'mrraw_%s_%s.json' % (os.path.basename(self.folder.rstrip('/')), tag)))
+		self.entries = []
+		self.mtime_ns = None
+		self.scanned = 0
+		
+		data = read_json(self.cachefile)
+		if data and data.get('folder') == self.folder:
+			self.entries = data['entries']
+			self.mtime_ns = data['mtime_ns']
+			self.scanned = data['scanned']
+	
+	@classmethod
+	def for_scanner(cls, scannerfolder, cachedir = default_cachedir):
+		
+		# DESCRIPTION: index for scanner folder, loaded once per process
+		
+		key = (str(scannerfolder), str(cachedir))
+		if key not in loaded:
+			loaded[key] = cls(scannerfolder, cachedir)
+		return loaded[key]
+	
+	def is_current(self):
+		
+		# DESCRIPTION: index is valid if folder mtime is unchanged
+		# folder mtimes may have coarse (1 s) resolution on NFS, so an index scanned within 2 s of the last change is not trusted
+		
+		mtime_ns = os.stat(self.folder).st_mtime_ns
+		return self.mtime_ns == mtime_ns and self.scanned - mtime_ns / 1e9 > 2
+	
+	def refresh(self, force = False):
+		
+		# DESCRIPTION: rescan scanner folder (single scandir pass) if needed and save index
+		
+		if not force and self.is_current():
+			return
+		mtime_ns = os.stat(self.folder).st_mtime_ns
+		scanned = time.time()
+		with os.scandir(self.folder) as it:
+			self.entries = sorted([entry.name for entry in it])
+		self.mtime_ns = mtime_ns
+		self.scanned = scanned
+		print('Source index updated: %s (%s sessions)' % (self.folder, len(self.entries)))
+		try:
+			os.makedirs(os.path.dirname(self.cachefile), exist_ok = True)
+			atomic_write_json(self.cachefile, {'folder': self.folder, 'mtime_ns': self.mtime_ns, 'scanned': self.scanned, 'entries': self.entries})
+		except OSError as e:
+			print('Source index not saved (%s)' % e) # index still used in memory
+	
+	def prefix_matches(self, prefix, limit = None):
+		
+		# DESCRIPTION: entries starting with prefix (bisection on sorted entries); limit stops the scan early
+		
+		matches = []
+		idx = bisect_left(self.entries, prefix)
+		while idx < len(self.entries) and self.entries[idx].startswith(prefix):
+			matches.append(self.entries[idx])
+			if limit and len(matches) >= limit:
+				break
+			idx += 1
+		return matches
+	
+	def resolve(self, prefix, limit = None):
+		
+		# DESCRIPTION: session folders matching an mr_id prefix (e.g. p231 -> p231sc...); a miss forces a rescan in case the index is stale
+		
+		self.refresh()
+		matches = self.prefix_matches(prefix, limit)
+		if not matches:
+			self.refresh(force = True)
+			matches = self.prefix_matches(prefix, limit)
+		return matches
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import sys
+import time
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+blocksize = 4 * 1024 * 1024
+window = 32 * 1024
+
+# blocks of one file read ahead and queued for compression at most (bounds memory per file, also when files share a pool)
+max_inflight = 8
+
+def deflate_block(block, dictionary, level, last):
+	
+	# DESCRIPTION: raw-deflate one block, primed with the preceding 32 kB so compression ratio matches serial gzip
+	# non-final blocks end with a sync flush (byte aligned, stream left open), so the blocks concatenate into one deflate stream
+	
+	if dictionary:
+		c = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+	else:
+		c = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY)
+	return c.compress(block) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def compress_file(src, dst = None, level = 6, pool = None, threads = None, remove = True):
+	
+	# DESCRIPTION: gzip src (e.g. .nii) to dst (default src + '.gz') with blocks compressed in parallel (as pigz)
+	# output is a single standard gzip member, readable by any gzip/zlib reader (nibabel, fsl, afni, ...)
+	# threads: threads of pool (a new pool is made if none is given); read-ahead is 2 blocks per thread, at most max_inflight
+	
+	dst = dst or src + '.gz'
+	threads = threads or os.cpu_count() or 1
+	inflight = min(max_inflight, 2 * threads)
+	ownpool = pool is None
+	if ownpool:
+		pool = ThreadPoolExecutor(max_workers = threads)
+	
+	tmpname = dst + '.part'
+	crc = 0
+	size = 0
+	try:
+		with open(src, 'rb') as fsrc, open(tmpname, 'wb') as fdst:
+			# gzip header: magic, deflate, no flags, mtime, no extra flags, os = unix
+			fdst.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, int(os.stat(src).st_mtime), 0, 3))
+			
+			# read ahead while earlier blocks are compressed
+			pending = deque()
+			previous = b''
+			block = fsrc.read(blocksize)
+			while True:
+				following = fsrc.read(blocksize) if block else b''
+				last = not following
+				pending.append(pool.submit(deflate_block, block, previous[-window:], level, last))
+				crc = zlib.crc32(block, crc)
+				size += len(block)
+				previous = block
+				block = following
+				while pending and (len(pending) >= inflight or last):
+					fdst.write(pending.popleft().result())
+				if last:
+					break
+			
+			fdst.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+		os.replace(tmpname, dst)
+	except BaseException:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+	finally:
+		if ownpool:
+			pool.shutdown()
+	
+	if remove:
+		os.remove(src)
+	return dst
+
+if __name__ == '__main__':
+	
+	# compress files from the command line, e.g. python3 parallel_gzip.py -6 -p 8 file1.nii file2.nii
+	
+	argumentList = sys.argv[1:]
+	level = 6
+	threads = os.cpu_count() or 1
+	files = []
+	while argumentList:
+		elem = argumentList.pop(0)
+		if elem == '-p':
+			threads = int(argumentList.pop(0))
+		elif len(elem) == 2 and elem[0] == '-' and elem[1].isdigit():
+			level = int(elem[1])
+		else:
+			files.append(elem)
+	
+	with ThreadPoolExecutor(max_workers = threads) as pool:
+		for fname in files:
+			start = time.time()
+			compress_file(fname, level = level, pool = pool, threads = threads)
+			print('%s.gz (%.1f s)' % (fname, time.time() - start))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import csv
+import json
+import hashlib
+import sqlite3
+from pathlib import Path
+
+from fsutil import atomic_write_text
+
+column_set = ['participant_id', 'session_id', 'mr_id']
+
+class ParticipantsRegistry():
+	
+	def __init__(self, dbfile, participants = None):
+		
+		# DESCRIPTION: indexed participant/session registry (sqlite, lookups by participant_id and mr_id); participants.tsv is exported from it
+		# columns of participants.tsv other than column_set (e.g. age, sex) are kept per row and written back on export
+		# participants.tsv is (re)imported when the registry is created and whenever the file changed after the last export (hand edits)
+		
+		self.dbfile = str(dbfile)
+		self.participants = str(participants) if participants else None
+		if self.dbfile != ':memory:':
+			os.makedirs(os.path.dirname(self.dbfile), exist_ok = True)
+		
+		# isolation_level None: transactions are opened explicitly (BEGIN IMMEDIATE) where needed
+		# default rollback journal (not WAL, which needs shared memory on one host); sqlite file locking is not reliable on network
+		# filesystems, concurrent conversions are serialized by the project lock (Source2Raw.project_lock) instead
+		self.conn = sqlite3.connect(self.dbfile, timeout = 300, isolation_level = None)
+		self.conn.execute('BEGIN IMMEDIATE')
+		try:
+			self.conn.execute('CREATE TABLE IF NOT EXISTS participants (participant_id TEXT NOT NULL, session_id TEXT NOT NULL, mr_id TEXT NOT NULL UNIQUE, extra TEXT, PRIMARY KEY (participant_id, session_id))')
+			self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+			
+			# registry written before extra columns were kept
+			if 'extra' not in [row[1] for row in self.conn.execute('PRAGMA table_info(participants)')]:
+				self.conn.execute('ALTER TABLE participants ADD COLUMN extra TEXT')
+			
+			if self.participants and os.path.exists(self.participants):
+				with open(self.participants, 'rb') as f:
+					content = f.read()
+				if hashlib.sha256(content).hexdigest() != self.get_meta('tsv_sha256'):
+					self.import_tsv(content.decode())
+			self.conn.execute('COMMIT')
+		except BaseException:
+			self.conn.execute('ROLLBACK')
+			raise
+	
+	@classmethod
+	def for_project(cls, projfolder, dry_run = False):
+		
+		# DESCRIPTION: registry stored with the project (hidden folder, ignored by bids-validator)
+		# dry_run: a missing registry is not created, an in-memory copy of participants.tsv is used instead
+		
+		dbfile = Path(projfolder, '.source2raw', 'participants.sqlite')
+		if dry_run and not os.path.exists(dbfile):
+			dbfile = ':memory:'
+		return cls(dbfile, Path(projfolder, 'participants.tsv'))
+	
+	def get_meta(self, key, default = None):
+		
+		row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return row[0] if row else default
+	
+	def set_meta(self, key, value):
+		
+		self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+	
+	def import_tsv(self, text):
+		
+		# DESCRIPTION: replace the registry by the rows of participants.tsv (text, read in __init__ inside its transaction)
+		# sessions registered since the last export are not in the file yet and are kept; ValueError if they conflict with it
+		
+		reader = csv.DictReader(text.splitlines(), delimiter = '\t')
+		columns = list(reader.fieldnames or column_set)
+		missing = [elem for elem in column_set if elem not in columns]
+		if missing:
+			raise ValueError('%s lacks columns: %s' % (self.participants, ', '.join(missing)))
+		rows = [(row['participant_id'], row['session_id'], row['mr_id'], json.dumps({key: val for key, val in row.items() if key not in column_set and key is not None})) for row in reader if row.get('participant_id')]
+		
+		last = int(self.get_meta('exported_rowid', 0))
+		pending = self.conn.execute('SELECT participant_id, session_id, mr_id, extra FROM participants WHERE rowid > ? ORDER BY rowid', (last,)).fetchall()
+		self.conn.execute('DELETE FROM participants')
+		cursor = self.conn.executemany('INSERT OR IGNORE INTO participants (participant_id, session_id, mr_id, extra) VALUES (?, ?, ?, ?)', rows)
+		print('%s of %s rows imported from %s' % (cursor.rowcount, len(rows), self.participants))
+		
+		# rows dropped because their mr_id or session was already listed with other values (exact repeats are just skipped)
+		dropped = [row[:3] for row in rows if self.lookup_mrid(row[2]) != row[:2]]
+		if dropped:
+			print('WARNING: %s rows in %s conflict with earlier rows (same mr_id or session) and were ignored: %s' % (len(dropped), self.participants, ', '.join(['%s %s %s' % row for row in dropped])))
+		
+		self.set_meta('columns', json.dumps(columns))
+		self.set_meta('tsv_sha256', hashlib.sha256(text.encode()).hexdigest())
+		self.set_meta('exported_rowid', str(self.conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM participants').fetchone()[0]))
+		for row in pending:
+			if self.lookup_mrid(row[2]) == row[:2]:
+				continue
+			try:
+				self.conn.execute('INSERT INTO participants (participant_id, session_id, mr_id, extra) VALUES (?, ?, ?, ?)', row)
+			except sqlite3.IntegrityError:
+				raise ValueError('%s was changed and conflicts with %s %s (%s), registered since the last export; fix the file' % (self.participants, row[0], row[1], row[2]))
+	
+	def lookup_mrid(self, mr_id):
+		
+		# DESCRIPTION: (participant_id, session_id) already assigned to mr_id, or None
+		
+		return self.conn.execute('SELECT participant_id, session_id FROM participants WHERE mr_id = ?', (mr_id,)).fetchone()
+	
+	def allocate_session(self, participant_id, mr_id, commit = True):
+		
+		# DESCRIPTION: return (session_id, nsessions, created) for mr_id; a new session number is allocated atomically
+		# nsessions is the number of sessions the participant had before this call; commit False: the number is only previewed (dry run)
+		
+		self.conn.execute('BEGIN IMMEDIATE')
+		try:
+			nsessions = self.conn.execute('SELECT COUNT(*) FROM participants WHERE participant_id = ?', (participant_id,)).fetchone()[0]
+			match = self.lookup_mrid(mr_id)
+			if match:
+				self.conn.execute('COMMIT')
+				if match[0] != participant_id:
+					raise ValueError('%s already assigned to %s (%s)' % (mr_id, match[0], match[1]))
+				return match[1], nsessions, False
+			session_id = 'ses-' + f"{nsessions+1:03d}"
+			self.conn.execute('INSERT INTO participants (participant_id, session_id, mr_id, extra) VALUES (?, ?, ?, ?)', (participant_id, session_id, mr_id, '{}'))
+			self.conn.execute('COMMIT' if commit else 'ROLLBACK')
+		except BaseException:
+			if self.conn.in_transaction:
+				self.conn.execute('ROLLBACK')
+			raise
+		return session_id, nsessions, True
+	
+	def export_tsv(self, fname):
+		
+		# DESCRIPTION: write participants.tsv (rows in order of registration, extra columns as imported, n/a where unknown),
+		# replacing the old file atomically; the written file is remembered, so only later hand edits are imported again
+		
+		self.conn.execute('BEGIN IMMEDIATE')
+		try:
+			columns = json.loads(self.get_meta('columns', 'null') or 'null') or column_set
+			rows = self.conn.execute('SELECT participant_id, session_id, mr_id, extra, rowid FROM participants ORDER BY rowid').fetchall()
+			lines = ['\t'.join(columns)]
+			for row in rows:
+				values = dict(json.loads(row[3] or '{}'), participant_id = row[0], session_id = row[1], mr_id = row[2])
+				lines.append('\t'.join([values.get(key) or 'n/a' for key in columns]))
+			text = '\n'.join(lines) + '\n'
+			atomic_write_text(fname, text)
+			self.set_meta('tsv_sha256', hashlib.sha256(text.encode()).hexdigest())
+			self.set_meta('exported_rowid', str(rows[-1][4] if rows else 0))
+			self.conn.execute('COMMIT')
+		except BaseException:
+			if self.conn.in_transaction:
+				self.conn.execute('ROLLBACK')
+			raise
+		print('%s file updated!' % fname)
+	
+	def close(self):
+		
+		self.conn.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import sys
+import os
+import csv
+import hashlib
+import sqlite3
+import argparse
+from pathlib import Path
+
+from fsutil import atomic_write_text
+
+scan_columns = ['filename', 'sidecar', 'participant_id', 'session_id', 'data_type', 'task', 'run', 'suffix', 'acq_date', 'acq_time', 'echo', 'size', 'mtime', 'sha256', 'source_series']
+
+def file_sha256(fname, blocksize = 1024 * 1024):
+	
+	h = hashlib.sha256()
+	with open(fname, 'rb') as f:
+		for block in iter(lambda: f.read(blocksize), b''):
+			h.update(block)
+	return h.hexdigest()
+
+class ScanIndex():
+	
+	def __init__(self, dbfile, projfolder):
+		
+		# DESCRIPTION: project-wide index of converted sessions and scans (sqlite), updated by each conversion
+		# filenames are stored relative to the project folder; scans.tsv/sessions.tsv are exported from it
+		# size and mtime (ns) are stored with the sha256, so unchanged files are not hashed again
+		
+		self.dbfile = str(dbfile)
+		self.projfolder = str(projfolder)
+		os.makedirs(os.path.dirname(self.dbfile), exist_ok = True)
+		self.conn = sqlite3.connect(self.dbfile, timeout = 300, isolation_level = None)
+		self.conn.execute('CREATE TABLE IF NOT EXISTS sessions (participant_id TEXT, session_id TEXT, mr_id TEXT, acq_date TEXT, acq_time TEXT, nscans INTEGER, updated TEXT, PRIMARY KEY (participant_id, session_id))')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS scans (%s, PRIMARY KEY (filename))' % ', '.join([elem + (' INTEGER' if elem in ['size', 'mtime'] else ' TEXT') for elem in scan_columns]))
+		
+		# index written before mtime was stored
+		if 'mtime' not in [row[1] for row in self.conn.execute('PRAGMA table_info(scans)')]:
+			try:
+				self.conn.execute('ALTER TABLE scans ADD COLUMN mtime INTEGER')
+			except sqlite3.OperationalError:
+				pass # added by a concurrent conversion
+		self.conn.execute('CREATE INDEX IF NOT EXISTS scans_session ON scans (participant_id, session_id)')
+		self.conn.execute('CREATE INDEX IF NOT EXISTS scans_task ON scans (data_type, task)')
+	
+	@classmethod
+	def for_project(cls, projfolder):
+		
+		return cls(Path(projfolder, '.source2raw', 'scan_index.sqlite'), projfolder)
+	
+	def update_session(self, participant_id, session_id, mr_id, scans):
+		
+		# DESCRIPTION: replace all scans of a session (scans: list of dicts with scan_columns, filenames relative to project folder)
+		
+		acq = sorted([(elem['acq_date'], elem['acq_time']) for elem in scans if elem['acq_time']])
+		acq_date, acq_time = acq[0] if acq else ('', '')
+		self.conn.execute('BEGIN IMMEDIATE')
+		try:
+			self.conn.execute('DELETE FROM scans WHERE participant_id = ? AND session_id = ?', (participant_id, session_id))
+			self.conn.executemany('INSERT OR REPLACE INTO scans (%s) VALUES (%s)' % (', '.join(scan_columns), ', '.join(['?'] * len(scan_columns))),
+					[[elem[key] for key in scan_columns] for elem in scans])
+			self.conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'))",
+					(participant_id, session_id, mr_id, acq_date, acq_time, len(scans)))
+			self.conn.execute('COMMIT')
+		except BaseException:
+			if self.conn.in_transaction:
+				self.conn.execute('ROLLBACK')
+			raise
+	
+	def file_hashes(self, participant_id, session_id):
+		
+		# DESCRIPTION: {filename: (size, mtime, sha256)} of the scans of a session
+		
+		rows = self.conn.execute('SELECT filename, size, mtime, sha256 FROM scans WHERE participant_id = ? AND session_id = ?', (participant_id, session_id))
+		return {row[0]: tuple(row[1:]) for row in rows}
+	
+	def query(self, **filters):
+		
+		# DESCRIPTION: scans matching column filters, e.g. query(data_type = 'func', task = 'rest')
+		
+		where = ' AND '.join(['%s = ?' % key for key in filters.keys() if key in scan_columns])
+		sql = 'SELECT %s FROM scans%s ORDER BY filename' % (', '.join(scan_columns), ' WHERE ' + where if where else '')
+		return [dict(zip(scan_columns, row)) for row in self.conn.execute(sql, [val for key, val in filters.items() if key in scan_columns])]
+	
+	def sessions(self, participant_id = None):
+		
+		columns = ['participant_id', 'session_id', 'mr_id', 'acq_date', 'acq_time', 'nscans', 'updated']
+		sql = 'SELECT %s FROM sessions%s ORDER BY participant_id, session_id' % (', '.join(columns), ' WHERE participant_id = ?' if participant_id else '')
+		return [dict(zip(columns, row)) for row in self.conn.execute(sql, [participant_id] if participant_id else [])]
+	
+	@staticmethod
+	def bids_acq_time(acq_date, acq_time):
+		
+		# DESCRIPTION: BIDS acq_time (YYYY-MM-DDThh:mm:ss); n/a without acquisition date
+		
+		if not acq_date or not acq_time:
+			return 'n/a'
+		return '%s-%s-%sT%s' % (acq_date[0:4], acq_date[4:6], acq_date[6:8], acq_time.split('.')[0])
+	
+	def export_scans_tsv(self, participant_id, session_id):
+		
+		# DESCRIPTION: write sub-<label>_ses-<label>_scans.tsv in session folder (filenames relative to session folder)
+		
+		sesfolder = Path(self.projfolder, participant_id, session_id)
+		lines = ['\t'.join(['filename', 'acq_time'])]
+		for elem in self.query(participant_id = participant_id, session_id = session_id):
+			lines.append('\t'.join([os.path.relpath(Path(self.projfolder, elem['filename']), sesfolder), self.bids_acq_time(elem['acq_date'], elem['acq_time'])]))
+		fname = str(Path(sesfolder, '_'.join([participant_id, session_id, 'scans.tsv'])))
+		atomic_write_text(fname, '\n'.join(lines) + '\n')
+		return fname
+	
+	def export_sessions_tsv(self, participant_id):
+		
+		# DESCRIPTION: write sub-<label>_sessions.tsv in subject folder
+		
+		lines = ['\t'.join(['session_id', 'acq_time', 'mr_id'])]
+		for elem in self.sessions(participant_id):
+			lines.append('\t'.join([elem['session_id'], self.bids_acq_time(elem['acq_date'], elem['acq_time']), elem['mr_id']]))
+		fname = str(Path(self.projfolder, participant_id, participant_id + '_sessions.tsv'))
+		atomic_write_text(fname, '\n'.join(lines) + '\n')
+		return fname
+	
+	def close(self):
+		
+		self.conn.close()
+
+if __name__ == '__main__':
+	
+	# query the scan index of a project, e.g. python3 scan_index.py /raw/np2-p2 --data_type func --task rest
+	
+	parser = argparse.ArgumentParser(description = 'Query the scan index of a converted project.')
+	parser.add_argument('projfolder')
+	parser.add_argument('--sessions', action = 'store_true', help = 'list sessions instead of scans')
+	parser.add_argument('--export', action = 'store_true', help = '(re)write all scans.tsv and sessions.tsv files')
+	for column in scan_columns:
+		parser.add_argument('--' + column)
+	args = parser.parse_args()
+	
+	if not os.path.exists(Path(args.projfolder, '.source2raw', 'scan_index.sqlite')):
+		sys.exit('No scan index found in %s' % args.projfolder)
+	index = ScanIndex.for_project(args.projfolder)
+	
+	if args.export:
+		for elem in index.sessions():
+			index.export_scans_tsv(elem['participant_id'], elem['session_id'])
+		for participant_id in sorted(set([elem['participant_id'] for elem in index.sessions()])):
+			index.export_sessions_tsv(participant_id)
+		print('Exported scans/sessions tsv files for %s sessions' % len(index.sessions()))
+	elif args.sessions:
+		rows = index.sessions(args.participant_id)
+		writer = csv.writer(sys.stdout, delimiter = '\t', lineterminator = '\n')
+		writer.writerow(['participant_id', 'session_id', 'mr_id', 'acq_date', 'acq_time', 'nscans', 'updated'])
+		writer.writerows([list(elem.values()) for elem in rows])
+	else:
+		rows = index.query(**{key: val for key, val in vars(args).items() if key in scan_columns and val is not None})
+		writer = csv.writer(sys.stdout, delimiter = '\t', lineterminator = '\n')
+		writer.writerow(scan_columns)
+		writer.writerows([list(elem.values()) for elem in rows])
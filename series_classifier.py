@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import sys
+import os
+import re
+import json
+from pathlib import Path
+
+# default rules file (name variants per data_type/label, update as needed)
+default_rules = str(Path(os.path.dirname(os.path.abspath(__file__)), 'series_rules.json'))
+
+# classifiers already built in this process, by rules file
+loaded = {}
+
+class SeriesClassifier():
+	
+	def __init__(self, rulesfile = default_rules):
+		
+		# DESCRIPTION: load classification rules and compile them into a single combined matcher
+		
+		self.rulesfile = str(rulesfile)
+		with open(self.rulesfile) as f:
+			self.config = json.load(f)
+		
+		self.data_types = list(self.config['data_types'])
+		self.rules = self.config['rules']
+		self.suffix = self.config.get('suffix', {})
+		self.task = self.config.get('task', [])
+		self.source_series = re.compile(self.config.get('source_series', '.'))
+		
+		# one named group per (data_type, label), each in its own optional zero-width lookahead: at every position all groups are tried,
+		# so overlapping variants (e.g. 'face' and 'faces') are all reported and a single finditer pass finds every label in a name
+		self.groups = {}
+		lookaheads = []
+		for data_type in self.data_types:
+			for label, variants in self.rules.get(data_type, {}).items():
+				group = 'g%d' % len(self.groups)
+				self.groups[group] = (data_type, label)
+				lookaheads.append('(?:(?=(?P<%s>%s)))?' % (group, '|'.join('(?:%s)' % v for v in variants)))
+		self.matcher = re.compile(''.join(lookaheads)) if lookaheads else None
+		
+		# label order as listed in the rules (used when joining several matching labels)
+		self.order = {val: idx for idx, val in enumerate(self.groups.values())}
+		self.cache = {}
+	
+	@classmethod
+	def for_rules(cls, rulesfile = default_rules):
+		
+		# DESCRIPTION: shared classifier for a rules file, so rules are read and compiled once per process
+		
+		rulesfile = str(rulesfile)
+		if rulesfile not in loaded:
+			loaded[rulesfile] = cls(rulesfile)
+		return loaded[rulesfile]
+	
+	def classify(self, name):
+		
+		# DESCRIPTION: return (data_type, task, suffix) for a series/file name; 'NA' if no data_type matches
+		# data_types are tried in listed order (first match wins), as are labels within a data_type
+		
+		name = name.lower()
+		if name in self.cache:
+			return self.cache[name]
+		
+		found = set()
+		if self.matcher is not None:
+			for m in self.matcher.finditer(name):
+				found.update([self.groups[group] for group, val in m.groupdict().items() if val is not None])
+		
+		result = ('NA', '', '')
+		for data_type in self.data_types:
+			labels = sorted([elem for elem in found if elem[0] == data_type], key = self.order.get)
+			if labels:
+				labels = ''.join([elem[1] for elem in labels])
+				task = labels if data_type in self.task else ''
+				result = (data_type, task, self.suffix.get(data_type, '').format(labels = labels))
+				break
+		
+		self.cache[name] = result
+		return result
+	
+	def classify_many(self, names):
+		
+		# DESCRIPTION: classify a list of names in one call, e.g. {name: (data_type, task, suffix)}
+		
+		return {name: self.classify(name) for name in names}
+	
+	def is_source_series(self, name):
+		
+		# DESCRIPTION: check whether a source folder is a series to be converted
+		
+		return bool(self.source_series.search(name))
+
+if __name__ == '__main__':
+	
+	# re-classify existing files/folders, e.g. python3 series_classifier.py /path/to/sesfolder
+	# input: folders (all entries listed) and/or names; output: tsv to stdout
+	
+	argumentList = sys.argv[1:]
+	if not argumentList:
+		sys.exit('Usage: series_classifier.py [--rules rules.json] folder_or_name [...]')
+	
+	rulesfile = default_rules
+	if argumentList[0] == '--rules':
+		rulesfile = argumentList[1]
+		argumentList = argumentList[2:]
+	
+	classifier = SeriesClassifier(rulesfile)
+	names = []
+	for elem in argumentList:
+		if os.path.isdir(elem):
+			names.extend(sorted(os.listdir(elem)))
+		else:
+			names.append(elem)
+	
+	print('\t'.join(['name', 'data_type', 'task', 'suffix']))
+	for name, result in classifier.classify_many(names).items():
+		print('\t'.join([name] + list(result)))
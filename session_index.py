@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+from bisect import bisect_left, insort
+
+class SessionIndex():
+	
+	def __init__(self, folder):
+		
+		# DESCRIPTION: cached listing of a session folder, built with a single scandir pass
+		# file names are kept sorted so all files of a series (same name prefix) form one contiguous block
+		
+		self.folder = str(folder)
+		self.refresh()
+	
+	def refresh(self):
+		
+		# DESCRIPTION: (re)build index from disk
+		
+		files = []
+		dirs = set()
+		with os.scandir(self.folder) as it:
+			for entry in it:
+				if entry.is_dir():
+					dirs.add(entry.name)
+				else:
+					files.append(entry.name)
+		self.files = sorted(files)
+		self.dirs = dirs
+	
+	def match(self, prefix, ext = ''):
+		
+		# DESCRIPTION: files starting with prefix (and ending with ext), found by bisection instead of testing every entry
+		
+		matches = []
+		idx = bisect_left(self.files, prefix)
+		while idx < len(self.files) and self.files[idx].startswith(prefix):
+			if self.files[idx].endswith(ext):
+				matches.append(self.files[idx])
+			idx += 1
+		return matches
+	
+	def add(self, name):
+		
+		# DESCRIPTION: register a file produced in the session folder
+		
+		if name not in self:
+			insort(self.files, name)
+	
+	def remove(self, name):
+		
+		# DESCRIPTION: unregister a file removed from (or moved out of) the session folder
+		
+		idx = bisect_left(self.files, name)
+		if idx < len(self.files) and self.files[idx] == name:
+			del self.files[idx]
+	
+	def rename(self, old, new):
+		
+		# DESCRIPTION: update index after os.rename; targets in subfolders (anat/func/fmap) leave the index
+		
+		self.remove(os.path.basename(old))
+		if os.path.dirname(os.path.abspath(new)) == os.path.abspath(self.folder):
+			self.add(os.path.basename(new))
+	
+	def __contains__(self, name):
+		
+		idx = bisect_left(self.files, name)
+		return idx < len(self.files) and self.files[idx] == name
+	
+	def __len__(self):
+		
+		return len(self.files)
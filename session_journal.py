@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import time
+import copy
+from pathlib import Path
+
+from fsutil import atomic_write_json, read_json
+
+class SessionJournal():
+	
+	def __init__(self, sesfolder):
+		
+		# DESCRIPTION: durable record of pipeline progress for one session folder (hidden file, ignored by bids-validator)
+		# series states: converting, converted, skipped, failed
+		# file states (sourcefile entries): classified, moved, removed
+		# sources: fingerprint (conversion cache key) and, in verify mode, content hash of each series' DICOM files when converted
+		
+		self.fname = str(Path(sesfolder, '.source2raw_journal.json'))
+		data = read_json(self.fname, {})
+		self.stages = data.get('stages', {})
+		self.series = data.get('series', {})
+		self.files = data.get('files', {})
+		self.sources = data.get('sources', {})
+		self.info = data.get('info', {})
+	
+	def adopt(self, other):
+		
+		# DESCRIPTION: start from the state recorded in another journal (e.g., published session when staging again)
+		
+		self.stages = copy.deepcopy(other.stages)
+		self.series = copy.deepcopy(other.series)
+		self.files = copy.deepcopy(other.files)
+		self.sources = copy.deepcopy(other.sources)
+		self.info = copy.deepcopy(other.info)
+	
+	def save(self):
+		
+		# DESCRIPTION: write journal atomically (fsync, so state survives a crash of the node)
+		
+		atomic_write_json(self.fname, {'info': self.info, 'stages': self.stages, 'series': self.series, 'files': self.files, 'sources': self.sources}, indent = 1, fsync = True)
+	
+	def set_stage(self, stage, **info):
+		
+		# DESCRIPTION: mark pipeline stage (resolve, convert, classify, assign_runs, move) as finished
+		
+		self.stages[stage] = dict(info, finished = time.strftime('%Y-%m-%dT%H:%M:%S'))
+		self.save()
+	
+	def stage_done(self, stage):
+		
+		return stage in self.stages
+	
+	def set_series(self, dcmfolder, state, save = True):
+		
+		self.series[dcmfolder] = state
+		if save:
+			self.save()
+	
+	def series_state(self, dcmfolder):
+		
+		return self.series.get(dcmfolder)
+	
+	def set_source(self, dcmfolder, key, content = None, save = True):
+		
+		self.sources[dcmfolder] = {'key': key, 'content': content}
+		if save:
+			self.save()
+	
+	def source(self, dcmfolder):
+		
+		return self.sources.get(dcmfolder)
+	
+	def discard_series(self, dcmfolder, save = True):
+		
+		# DESCRIPTION: forget a series and its images (e.g., source changed and series is converted again); returns removed file entries
+		
+		removed = {elem: entry for elem, entry in self.files.items() if entry.get('series') == dcmfolder}
+		for elem in removed:
+			del self.files[elem]
+		self.series.pop(dcmfolder, None)
+		self.sources.pop(dcmfolder, None)
+		if save:
+			self.save()
+		return removed
+	
+	def set_file(self, elem, entry, save = True):
+		
+		# DESCRIPTION: store sourcefile entry (classification, run, target names and state) for an intermediate image
+		
+		self.files[elem] = dict(entry)
+		if save:
+			self.save()
+	
+	def file_state(self, elem):
+		
+		return self.files.get(elem, {}).get('state')
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import sys
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from fsutil import atomic_write_text, atomic_write_json, read_json
+from stage_publish import fsync_dir
+
+# operations are applied phase by phase, in this order
+phases = ['mkdir', 'edit_json', 'rename', 'remove']
+
+# removed files are renamed aside first and deleted once the whole plan succeeded
+trash_prefix = '.source2raw-removed.'
+
+class SessionPlan():
+	
+	def __init__(self, folder, ops = None):
+		
+		# DESCRIPTION: filesystem operations that turn converted images in a session (or staging) folder into the bids layout,
+		# computed before anything is changed, so they can be checked, saved for a dry run and applied in one step
+		# ops: mkdir (path), edit_json (path, set: fields to set), rename (src, dst), remove (path); elem: image the operation belongs to
+		
+		self.folder = str(folder)
+		self.ops = list(ops or [])
+	
+	@classmethod
+	def load(cls, fname):
+		
+		data = read_json(fname)
+		if not data:
+			raise ValueError('Not a plan file: %s' % fname)
+		return cls(data['folder'], data['ops'])
+	
+	def save(self, fname):
+		
+		atomic_write_json(fname, {'folder': self.folder, 'ops': self.ops}, indent = 1)
+	
+	def add(self, op, elem = None, **fields):
+		
+		self.ops.append(dict(fields, op = op, elem = elem))
+	
+	def target(self, op):
+		
+		return op['dst'] if op['op'] == 'rename' else op['path']
+	
+	def grouped(self, phase):
+		
+		# DESCRIPTION: operations of one phase as [(directory, ops)], sorted by directory (renames by target directory)
+		
+		groups = {}
+		for op in self.ops:
+			if op['op'] == phase:
+				groups.setdefault(os.path.dirname(self.target(op)), []).append(op)
+		return sorted(groups.items())
+	
+	def summary(self):
+		
+		counts = [(phase, len([op for op in self.ops if op['op'] == phase])) for phase in phases]
+		return ', '.join(['%s %s' % (n, phase) for phase, n in counts if n]) or 'nothing to do'
+	
+	def describe(self):
+		
+		# DESCRIPTION: one line per operation, paths relative to the plan folder
+		
+		rel = lambda path: os.path.relpath(path, self.folder)
+		lines = []
+		for phase in phases:
+			for folder, ops in self.grouped(phase):
+				for op in ops:
+					if phase == 'rename':
+						lines.append('RENAME %s -> %s' % (rel(op['src']), rel(op['dst'])))
+					elif phase == 'edit_json':
+						lines.append('EDIT %s (%s)' % (rel(op['path']), ', '.join(['%s=%s' % (key, val) for key, val in op['set'].items()])))
+					else:
+						lines.append('%s %s' % (phase.upper(), rel(op['path'])))
+		return lines
+	
+	def check(self):
+		
+		# DESCRIPTION: problems that would make the plan fail or lose data, found without changing anything (one listing per directory):
+		# missing sources, several images renamed to the same name, targets that already exist
+		
+		listings = {}
+		
+		def exists(path):
+			folder = os.path.dirname(path)
+			if folder not in listings:
+				listings[folder] = set(os.listdir(folder)) if os.path.isdir(folder) else set()
+			return os.path.basename(path) in listings[folder]
+		
+		problems = []
+		targets = {}
+		moved = set([op['src'] for op in self.ops if op['op'] == 'rename'] + [op['path'] for op in self.ops if op['op'] == 'remove'])
+		for op in self.ops:
+			if op['op'] == 'mkdir':
+				if exists(op['path']) and not os.path.isdir(op['path']):
+					problems.append('%s exists and is not a folder' % op['path'])
+			elif op['op'] == 'rename':
+				if not exists(op['src']):
+					problems.append('%s not found' % op['src'])
+				if op['dst'] in targets:
+					problems.append('%s and %s both renamed to %s' % (targets[op['dst']], op['src'], op['dst']))
+				elif exists(op['dst']) and op['dst'] not in moved:
+					problems.append('%s already exists' % op['dst'])
+				targets[op['dst']] = op['src']
+			elif not exists(op['path']):
+				problems.append('%s not found' % op['path'])
+		return list(dict.fromkeys(problems))
+	
+	def apply(self):
+		
+		# DESCRIPTION: apply all operations phase by phase, grouped by directory; if any operation fails, everything done so far is
+		# undone in reverse order and the error raised, so the folder is left as it was; raises ValueError if check() finds problems
+		
+		problems = self.check()
+		if problems:
+			raise ValueError('Plan not applied: %s' % '; '.join(problems))
+		
+		# files set aside by an earlier run that was killed while applying its plan
+		for folder in sorted(set([os.path.dirname(op['path']) for op in self.ops if op['op'] == 'remove'])):
+			for fname in os.listdir(folder):
+				if fname.startswith(trash_prefix):
+					os.remove(Path(folder, fname))
+		
+		undo = []
+		trash = []
+		try:
+			for phase in phases:
+				for folder, ops in self.grouped(phase):
+					if phase == 'edit_json':
+						self.edit_sidecars(ops, undo)
+						continue
+					for op in ops:
+						if phase == 'mkdir':
+							if not os.path.isdir(op['path']):
+								os.mkdir(op['path'])
+								undo.append(('rmdir', op['path']))
+						elif phase == 'rename':
+							os.rename(op['src'], op['dst'])
+							undo.append(('rename', op['dst'], op['src']))
+						else:
+							aside = str(Path(folder, trash_prefix + os.path.basename(op['path'])))
+							os.rename(op['path'], aside)
+							undo.append(('rename', aside, op['path']))
+							trash.append(aside)
+		except BaseException:
+			self.rollback(undo)
+			raise
+		
+		for fname in trash:
+			os.remove(fname)
+		
+		# make the new directory entries durable (once per directory)
+		for folder in sorted(set([os.path.dirname(self.target(op)) for op in self.ops] + [os.path.dirname(op['src']) for op in self.ops if op['op'] == 'rename'])):
+			fsync_dir(folder)
+	
+	def edit_sidecars(self, ops, undo):
+		
+		# DESCRIPTION: set fields in json sidecars in parallel (each replaced atomically, old text kept for rollback)
+		# sidecars that already have the values are not rewritten
+		
+		def edit(op):
+			with open(op['path']) as f:
+				text = f.read()
+			data = json.loads(text)
+			if all([data.get(key) == val for key, val in op['set'].items()]):
+				return None
+			data.update(op['set'])
+			atomic_write_text(op['path'], json.dumps(data, indent = 4))
+			return ('restore', op['path'], text)
+		
+		with ThreadPoolExecutor(max_workers = min(8, len(ops))) as pool:
+			futures = [pool.submit(edit, op) for op in ops]
+		error = None
+		for future in futures:
+			try:
+				result = future.result()
+			except Exception as e:
+				error = error or e
+				continue
+			if result is not None:
+				undo.append(result)
+		if error is not None:
+			raise error
+	
+	def rollback(self, undo):
+		
+		print('Plan failed, undoing %s operations in %s' % (len(undo), self.folder))
+		for action in reversed(undo):
+			try:
+				if action[0] == 'rmdir':
+					os.rmdir(action[1])
+				elif action[0] == 'rename':
+					os.rename(action[1], action[2])
+				else:
+					atomic_write_text(action[1], action[2])
+			except OSError as e:
+				print('Undo failed (%s %s): %s' % (action[0], action[1], e))
+
+if __name__ == '__main__':
+	
+	# check saved plans (e.g. written by source2raw.py --plan or batch_source2raw.py --plan) before applying them
+	# python3 session_plan.py plans/*.plan.json [-v]
+	
+	verbose = '-v' in sys.argv[1:]
+	fnames = [elem for elem in sys.argv[1:] if elem != '-v']
+	if not fnames:
+		sys.exit('Usage: session_plan.py <plan.json> ... [-v]')
+	nproblems = 0
+	for fname in fnames:
+		plan = SessionPlan.load(fname)
+		problems = plan.check()
+		nproblems += len(problems)
+		print('%s: %s (%s)' % (fname, plan.summary(), '%s problems' % len(problems) if problems else 'ok'))
+		if verbose:
+			for line in plan.describe():
+				print('  %s' % line)
+		for problem in problems:
+			print('  PROBLEM: %s' % problem)
+	if nproblems:
+		sys.exit(1)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import argparse
+import csv
+import io
+import os
+import re
+import sys
+import time
+import zlib
+import subprocess
+from pathlib import Path
+
+from source2raw import Source2Raw
+from batch_source2raw import read_manifest, resolved_mrid, convert_session, export_participants, write_report, inputvarList, session_gz_threads
+from lease import Lease, Heartbeat
+from fsutil import atomic_write_text, atomic_write_json, read_json
+
+# work folder layout (on the shared filesystem, visible to all nodes)
+# options.json: conversion settings used by every worker; shards/: manifest split; leases/: claimed sessions;
+# locks/: subject locks; done/ and failed/: one result file per finished session; logs/: per-session output
+
+def session_key(session):
+	
+	return re.sub('[^A-Za-z0-9_.-]', '_', '_'.join([session['project_id'], session['cimbi_id'], session['mr_id']]))
+
+def split_manifest(sessions, workdir, nshards, options = None):
+	
+	# DESCRIPTION: write shards of a manifest; all sessions of a subject go to the same shard (in manifest order), so
+	# subjects rarely compete across nodes and session numbers follow the manifest
+	
+	# duplicates by the source session an mr_id resolves to (p231 and p231sc may be the same session)
+	mrsource = (options or {}).get('mrsource') or Source2Raw.mrsource
+	shards = [[] for k in range(nshards)]
+	seen = set()
+	for session in sessions:
+		key = session_key(dict(session, mr_id = resolved_mrid(session, mrsource)))
+		if key in seen:
+			print('Duplicate manifest entry skipped: %s' % ' '.join([session[elem] for elem in inputvarList]))
+			continue
+		seen.add(key)
+		shards[zlib.crc32(('%s/%s/%s' % (session['raw_id'], session['project_id'], session['cimbi_id'])).encode()) % nshards].append(session)
+	
+	for folder in ['shards', 'leases', 'locks', 'done', 'failed', 'logs']:
+		os.makedirs(Path(workdir, folder), exist_ok = True)
+	for k, shard in enumerate(shards):
+		text = io.StringIO()
+		writer = csv.DictWriter(text, fieldnames = inputvarList, delimiter = '\t', lineterminator = '\n')
+		writer.writeheader()
+		writer.writerows(shard)
+		atomic_write_text(str(Path(workdir, 'shards', 'shard-%03d.tsv' % k)), text.getvalue())
+	atomic_write_json(str(Path(workdir, 'options.json')), dict(options or {}, nshards = nshards), indent = 1)
+	print('%s sessions split into %s shards (%s)' % (len(seen), nshards, ', '.join([str(len(shard)) for shard in shards])))
+
+def read_shards(workdir, first = None):
+	
+	# DESCRIPTION: sessions of all shards, shard first (if given) first; workers continue with other shards once theirs is done
+	
+	fnames = sorted(os.listdir(Path(workdir, 'shards')))
+	if first is not None:
+		own = 'shard-%03d.tsv' % first
+		fnames = [elem for elem in fnames if elem == own] + [elem for elem in fnames if elem != own]
+	sessions = []
+	for fname in fnames:
+		sessions.extend(read_manifest(str(Path(workdir, 'shards', fname))))
+	return sessions
+
+class ShardWorker():
+	
+	def __init__(self, workdir, shard = None, ttl = 300, poll = 10, retry_failed = False, node_workers = 1):
+		
+		# DESCRIPTION: convert sessions of a sharded manifest; any number of workers on any node may run on the same workdir
+		# a session is claimed with a lease (heartbeat every ttl/4; a dead worker's sessions are taken over after ttl)
+		# and converted while holding its subject lock, so sessions of one subject are never converted concurrently
+		
+		self.workdir = str(workdir)
+		self.shard = shard
+		self.ttl = ttl
+		self.poll = poll
+		self.options = read_json(str(Path(self.workdir, 'options.json')), {})
+		self.options.pop('nshards', None)
+		
+		# sessions of different nodes share the raw tree: project lock as lease, participants.tsv exported by the coordinator
+		self.options.update({'lease_locks': True, 'export_participants': False})
+		
+		# compression threads not given at split: share the cpus of this node between its node_workers workers
+		if self.options.get('gz_threads') is None:
+			self.options['gz_threads'] = session_gz_threads(node_workers)
+		if retry_failed:
+			for fname in os.listdir(Path(self.workdir, 'failed')):
+				os.remove(Path(self.workdir, 'failed', fname))
+	
+	def finished(self, session):
+		
+		key = session_key(session) + '.json'
+		return os.path.exists(Path(self.workdir, 'done', key)) or os.path.exists(Path(self.workdir, 'failed', key))
+	
+	def record(self, session, result):
+		
+		folder = 'done' if result['status'] == 'ok' else 'failed'
+		atomic_write_json(str(Path(self.workdir, folder, session_key(session) + '.json')), dict(result, worker = '%s:%s' % (os.uname()[1], os.getpid())), fsync = True)
+	
+	def subject_lock(self, session):
+		
+		return Lease(Path(self.workdir, 'locks', re.sub('[^A-Za-z0-9_.-]', '_', '_'.join([session['project_id'], session['cimbi_id']])) + '.lease'), self.ttl)
+	
+	def convert(self, session, heartbeat):
+		
+		# DESCRIPTION: claim and convert one session; returns result, or None if claimed elsewhere or subject busy
+		
+		lease = Lease(Path(self.workdir, 'leases', session_key(session) + '.lease'), self.ttl)
+		if not lease.try_acquire():
+			return None
+		heartbeat.add(lease)
+		try:
+			# finished by another worker between listing and claiming
+			if self.finished(session):
+				return None
+			subject = self.subject_lock(session)
+			if not subject.try_acquire():
+				return None # another session of this subject is being converted, try again later
+			heartbeat.add(subject)
+			try:
+				print('Converting %s -> %s %s' % (session['mr_id'], session['project_id'], session['cimbi_id']))
+				result = convert_session(session, str(Path(self.workdir, 'logs')), dict(self.options, leases = [lease, subject]))
+				
+				# claim lost while converting (worker stalled longer than ttl): the worker that took it over records the session
+				lost = [elem.fname for elem in [lease, subject] if elem in heartbeat.lost or not elem.check()]
+				if lost:
+					print('Lease lost, result of %s discarded: %s' % (session['mr_id'], ', '.join(lost)))
+					return None
+				self.record(session, result)
+				print('%s %s: %s' % (result['status'].upper(), session['mr_id'], result['message']))
+				return result
+			finally:
+				heartbeat.discard(subject)
+				subject.release()
+		finally:
+			heartbeat.discard(lease)
+			lease.release()
+	
+	def run(self):
+		
+		# DESCRIPTION: convert until every session is done or failed (sessions held by live workers are waited for)
+		
+		sessions = read_shards(self.workdir, self.shard)
+		heartbeat = Heartbeat(interval = self.ttl / 4)
+		results = []
+		try:
+			while True:
+				remaining = [session for session in sessions if not self.finished(session)]
+				if not remaining:
+					break
+				# sessions of a subject are converted in manifest order (session numbers), later ones wait for earlier ones
+				progressed = False
+				blocked = set()
+				for session in remaining:
+					subject = (session['raw_id'], session['project_id'], session['cimbi_id'])
+					if subject in blocked or self.finished(session):
+						continue
+					result = self.convert(session, heartbeat)
+					if result is not None:
+						results.append(result)
+						progressed = True
+					elif not self.finished(session):
+						blocked.add(subject)
+				if not progressed:
+					time.sleep(self.poll)
+		finally:
+			heartbeat.stop()
+		print('Worker done: %s sessions converted here' % len(results))
+		return results
+
+def collect_results(workdir):
+	
+	results = []
+	for folder in ['done', 'failed']:
+		for fname in sorted(os.listdir(Path(workdir, folder))):
+			if fname.endswith('.json'):
+				results.append(read_json(str(Path(workdir, folder, fname))))
+	return [elem for elem in results if elem]
+
+def status(workdir):
+	
+	# DESCRIPTION: print progress of a sharded run; returns (done, failed, running, pending)
+	
+	sessions = read_shards(workdir)
+	keys = set([session_key(session) for session in sessions])
+	done = len([elem for elem in os.listdir(Path(workdir, 'done')) if elem[:-5] in keys])
+	failed = len([elem for elem in os.listdir(Path(workdir, 'failed')) if elem[:-5] in keys])
+	running = len([elem for elem in os.listdir(Path(workdir, 'leases')) if elem.endswith('.lease')])
+	pending = len(keys) - done - failed - running
+	print('%s sessions: %s done, %s failed, %s running, %s pending' % (len(keys), done, failed, running, pending))
+	return done, failed, running, pending
+
+def launch(workdir, nworkers, ttl = 300, poll = 10):
+	
+	# DESCRIPTION: start nworkers local worker processes on a workdir (e.g. for testing, or one launcher per node)
+	
+	nshards = read_json(str(Path(workdir, 'options.json')), {}).get('nshards', 1)
+	procs = []
+	for k in range(nworkers):
+		cmd = [sys.executable, os.path.abspath(__file__), 'work', workdir, '--shard', str(k % nshards), '--ttl', str(ttl), '--poll', str(poll), '--node_workers', str(nworkers)]
+		procs.append(subprocess.Popen(cmd, stdout = open(Path(workdir, 'logs', 'worker-%s.log' % k), 'w'), stderr = subprocess.STDOUT))
+	print('%s workers started' % nworkers)
+	return [proc.wait() for proc in procs]
+
+def finalize(workdir, report = None):
+	
+	# DESCRIPTION: export participants.tsv of every project once and optionally write a report of all sessions
+	
+	results = collect_results(workdir)
+	export_participants(results)
+	if report:
+		write_report(results, report)
+	return results
+
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description = 'Convert a session manifest on several nodes sharing one filesystem.')
+	subparsers = parser.add_subparsers(dest = 'command', required = True)
+	
+	sub = subparsers.add_parser('split', help = 'split a manifest into shards (coordinator)')
+	sub.add_argument('manifest')
+	sub.add_argument('workdir', help = 'work folder on the shared filesystem')
+	sub.add_argument('-n', '--shards', type = int, default = 4)
+	sub.add_argument('--raw_id', help = 'raw folder used for all rows')
+	sub.add_argument('--mrsource', default = Source2Raw.mrsource)
+	sub.add_argument('--series_jobs', type = int, default = 1)
+	sub.add_argument('--gz_threads', type = int, help = 'default: cpu count of each node / workers on the node')
+	sub.add_argument('--scratch', help = 'node-local staging folder')
+	sub.add_argument('--continue_on_error', action = 'store_true')
+	
+	for name, text in [('work', 'run a worker (on any node)'), ('launch', 'run several local workers and finalize')]:
+		sub = subparsers.add_parser(name, help = text)
+		sub.add_argument('workdir')
+		sub.add_argument('--shard', type = int, help = 'shard to start with')
+		sub.add_argument('-j', '--workers', type = int, default = 2, help = 'launch: number of worker processes')
+		sub.add_argument('--ttl', type = int, default = 300, help = 'seconds without heartbeat before a claim expires')
+		sub.add_argument('--poll', type = float, default = 10, help = 'seconds between scans while waiting for other workers')
+		sub.add_argument('--retry_failed', action = 'store_true')
+		sub.add_argument('--node_workers', type = int, default = 1, help = 'work: number of workers running on this node (sets the default gz_threads)')
+		sub.add_argument('--report')
+	
+	sub = subparsers.add_parser('status', help = 'show progress, export participants.tsv when finished')
+	sub.add_argument('workdir')
+	sub.add_argument('--report')
+	args = parser.parse_args()
+	
+	if args.command == 'split':
+		sessions = read_manifest(args.manifest, args.raw_id)
+		options = {'mrsource': args.mrsource, 'd2n_workers': args.series_jobs, 'gz_threads': args.gz_threads, 'scratch': args.scratch, 'd2n_policy': 'continue' if args.continue_on_error else 'failfast'}
+		split_manifest(sessions, args.workdir, args.shards, options)
+	elif args.command == 'work':
+		ShardWorker(args.workdir, shard = args.shard, ttl = args.ttl, poll = args.poll, retry_failed = args.retry_failed, node_workers = args.node_workers).run()
+	elif args.command == 'launch':
+		if args.retry_failed:
+			ShardWorker(args.workdir, retry_failed = True)
+		launch(args.workdir, args.workers, ttl = args.ttl, poll = args.poll)
+		finalize(args.workdir, args.report)
+		done, failed, running, pending = status(args.workdir)
+		if failed:
+			sys.exit(1)
+	elif args.command == 'status':
+		done, failed, running, pending = status(args.workdir)
+		if not running and not pending:
+			finalize(args.workdir, args.report)
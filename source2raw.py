@@ -9,26 +9,61 @@ Created on Wed Feb  2 11:49:05 2022
 # Relevant libraries
 import sys
 import os
-import pandas as pd
+import csv
 import re
 from pathlib import Path
 import json
+import fcntl
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Input from command line
-allargs = sys.argv
+from session_index import SessionIndex
+from series_classifier import SeriesClassifier
+from participants_registry import ParticipantsRegistry
+from mrraw_index import MRrawIndex
+from session_journal import SessionJournal
+from stage_publish import publish_tree
+from parallel_gzip import compress_file
+from conversion_cache import ConversionCache, series_fingerprint, series_content_hash
+from scan_index import ScanIndex, file_sha256
+from session_plan import SessionPlan
+from tracing import Tracer
+from lease import hold
+from CreateDatasetDescription import DatasetDescrption
+from contextlib import contextmanager
+
+class Source2RawError(Exception):
+	
+	# raised when a session cannot be converted (bad input, ambiguous mr_id, failed conversion, ...); main() reports it and exits
+	pass
 
 class Source2Raw():
 	
-	def __init__(self):
+	# nru specific variables: source data folder and scanner folder for first character of mr_id
+	mrsource = '/rawdata/mr-rh/MRraw'
+	mrscanners = {'p': 'prisma', 'n': 'mr001', 'm': 'mmr', 'v': 'verio'}
+	
+	# settings accepted as keyword arguments (attributes documented in __init__)
+	setting_names = ['prescan', 'export_participants', 'lease_locks', 'leases', 'scratch', 'use_cache', 'cache_verify', 'cache_size',
+			'trace_dir', 'profile', 'profile_memory', 'plan_dir', 'index_hash', 'gz_threads', 'gz_level', 'd2n_path', 'd2n_workers', 'd2n_policy']
+	
+	def __init__(self, raw_id, project_id, cimbi_id, mr_id, mrsource = None, **settings):
+		
+		# DESCRIPTION: one session to convert; settings are any of setting_names (e.g. scratch = '/scratch', d2n_workers = 2)
 		
-		argumentList = allargs[1:]
-		if not len(argumentList) == 4:
-			sys.exit('Four required inputs (in order): raw_id, project_id, cimbi_id, mr_id; %s inputs received' % str(len(argumentList)))
+		for key in settings:
+			if key not in self.setting_names:
+				raise TypeError('Unknown Source2Raw setting: %s' % key)
 		
 		# input variables
-		inputvarList = ['raw_id', 'project_id','cimbi_id','mr_id']
-		self.inputvar = {inputvarList[i]: argumentList[i] for i in range(len(argumentList))}
-		self.inputcmd = ' '.join(allargs)
+		self.inputvar = {'raw_id': str(raw_id), 'project_id': str(project_id), 'cimbi_id': str(cimbi_id), 'mr_id': str(mr_id)}
+		for key, val in self.inputvar.items():
+			if not val:
+				raise Source2RawError('Empty input: %s' % key)
+		if self.inputvar['mr_id'][0] not in self.mrscanners:
+			raise Source2RawError('Unknown scanner for mr_id %s (first character one of: %s)' % (self.inputvar['mr_id'], ', '.join(self.mrscanners.keys())))
 		
 		# display inputs
 		print('Inputs received:')
@@ -40,8 +75,9 @@ class Source2Raw():
 			self.inputvar['raw_id'] = self.inputvar['raw_id'][:-1]
 		
 		# nru specific variables
-		self.mrsource = '/rawdata/mr-rh/MRraw'
-		self.mrscanner = {'p': 'prisma', 'n': 'mr001', 'm': 'mmr', 'v': 'verio'}[self.inputvar['mr_id'][0]]
+		if mrsource:
+			self.mrsource = mrsource
+		self.mrscanner = self.mrscanners[self.inputvar['mr_id'][0]]
 		
 		# bids elements
 		self.bidsinfo = {
@@ -51,141 +87,321 @@ class Source2Raw():
 				'sub': 'sub-' + self.inputvar['cimbi_id'],
 				'subfolder': str(Path(self.inputvar['raw_id'], self.inputvar['project_id'], 'sub-' + self.inputvar['cimbi_id'])),
 				'dataset_description': Path(self.inputvar['raw_id'], self.inputvar['project_id'], 'dataset_description.json'),
-				'participants': str(Path(self.inputvar['raw_id'], self.inputvar['project_id'], 'participants.tsv'))}
+				'participants': str(Path(self.inputvar['raw_id'], self.inputvar['project_id'], 'participants.tsv')),
+				'projlock': str(Path(self.inputvar['raw_id'], '.' + self.inputvar['project_id'] + '.lock'))}
+		
+		# series classification rules: data_types, tasks and name variants (update series_rules.json as needed); loaded once per process
+		self.classifier = SeriesClassifier.for_rules()
+		self.bids_data_types = self.classifier.data_types
+		
+		# read one DICOM header per series before conversion and skip series that would be discarded (requires pydicom)
+		self.prescan = True
+		self.pydicom = None
+		
+		# write participants.tsv whenever a session is added (batch mode exports once at the end instead)
+		self.export_participants = True
+		
+		# project lock as lease file instead of fcntl (sharded mode: nodes sharing the raw tree over a network filesystem)
+		# leases: Lease objects that must still be held, checked before each stage (sharded mode: session claim, subject lock);
+		# if one was lost (expired and taken over by another worker), the conversion is aborted
+		self.lease_locks = False
+		self.leases = []
+		
+		# local scratch folder for staging (e.g. /scratch or /dev/shm); None converts directly into the session folder
+		self.scratch = None
+		
+		# conversion cache: reuse outputs of series converted before (same SeriesInstanceUID and DICOM files); verify also checks file contents
+		self.use_cache = True
+		self.cache_verify = False
+		self.cache_size = 100000
+		self.dcmheaders = {}
+		self.series_keys = {}
+		self.converted_series = []
 		
-		self.bids_data_types = ['anat','func','fmap']
+		# tracing: JSON-lines events per stage and series in <trace_dir>/<project_id>_<cimbi_id>_<mr_id>.jsonl (plus .summary.json)
+		# profile: stages (or per-series spans, e.g. 'dcm2niix') run under cProfile; profile_memory: also under tracemalloc
+		self.trace_dir = None
+		self.profile = []
+		self.profile_memory = False
+		self.tracer = Tracer()
 		
-		# list of available directories and name variants (update as needed)
-		self.func_dictionary = {'faces': ['faces'], 'reward': ['reward'], 'rest': ['rest', 'resting'], 'aarhus': ['aarhus'], 'music': ['music']}
-		self.anat_dictionary = {'T1': ['t1'], 'T2': ['t2']}
-		self.fmap_dictionary = {'GRE_FIELD_MAPPING': ['gre_field_mapping']}
+		# dry run: stop after classification and write the plan of file operations to <plan_dir>/<project_id>_<cimbi_id>_<mr_id>.plan.json
+		# the raw folder is not changed: missing folders are only reported, the session number is previewed without registering it,
+		# and images are converted into <plan_dir>/staging/<project_id>_<cimbi_id>_<mr_id> (scratch is not used)
+		self.plan_dir = None
+		
+		# project scan index: also store sha256 of every nifti file
+		self.index_hash = True
+		
+		# nifti compression: with more than one thread, dcm2niix writes .nii and a separate block-parallel gzip stage compresses it
+		self.gz_threads = os.cpu_count() or 1
+		self.gz_level = 6
+		
+		# dcm2niix settings: number of series converted in parallel and what to do if a series fails ('failfast' or 'continue')
+		self.d2n_path = 'dcm2niix'
+		self.d2n_workers = min(4, os.cpu_count() or 1)
+		self.d2n_policy = 'failfast'
 		
 		 # currently not used (delete?)
 		self.raw_file_types = ['T1', 'T2', 'EP2D', 'GRE']
 		
+		for key, val in settings.items():
+			setattr(self, key, val)
+	
+	def classify_name(self, name):
+		
+		# DESCRIPTION: match a series/file name to a bids data_type; returns (data_type, task, suffix)
+		# fmap suffix depends on ImageType and is set by classify_header
+		
+		return self.classifier.classify(name)
+	
+	def classify_header(self, data_type, suffix, ImageType, EchoNumber, strict = True):
+		
+		# DESCRIPTION: apply ImageType/EchoNumber rules to a name-based classification; an empty suffix means the image is skipped
+		
+		if data_type == 'fmap':
+			if 'PHASE' in ImageType:
+				suffix = 'phasediff'
+			elif 'NORM' in ImageType:
+				if EchoNumber != '':
+					suffix = 'magnitude' + str(EchoNumber)
+				elif strict:
+					raise Source2RawError('EchoNumber expected but not found.')
+				else:
+					suffix = 'magnitude'
+			else:
+				suffix = ''
+		
+		# remove anat image suffix if not ND (will result in being skipped)
+		elif data_type == 'anat':
+			if 'ND' not in ImageType:
+				suffix = ''
+		
+		elif data_type == 'NA':
+			suffix = ''
+		
+		return suffix
+	
+	def read_dcmheader(self, seriesFolder):
+		
+		# DESCRIPTION: read the header of the first readable DICOM file in a series folder (pixel data not loaded)
+		
+		header_tags = ['ImageType', 'EchoNumbers', 'AcquisitionDate', 'AcquisitionTime', 'SeriesDescription', 'SeriesInstanceUID']
+		with os.scandir(seriesFolder) as it:
+			for entry in it:
+				if entry.name.startswith('.') or not entry.is_file():
+					continue
+				try:
+					ds = self.pydicom.dcmread(entry.path, stop_before_pixels = True, specific_tags = header_tags)
+				except Exception:
+					continue # not a DICOM file (e.g., DICOMDIR or text file), try next
+				if 'ImageType' not in ds:
+					continue
+				
+				# a single ImageType value is returned as str, not MultiValue
+				if ds.ImageType is None:
+					ImageType = []
+				elif isinstance(ds.ImageType, self.pydicom.multival.MultiValue):
+					ImageType = [str(v) for v in ds.ImageType]
+				else:
+					ImageType = [str(ds.ImageType)]
+				return {
+						'ImageType': ImageType,
+						'EchoNumber': str(ds.get('EchoNumbers', '') or ''),
+						'AcquisitionDate': str(ds.get('AcquisitionDate', '') or ''),
+						'AcquisitionTime': str(ds.get('AcquisitionTime', '') or ''),
+						'SeriesDescription': str(ds.get('SeriesDescription', '') or ''),
+						'SeriesInstanceUID': str(ds.get('SeriesInstanceUID', '') or '')}
+		return None
+	
+	def prescan_dcmfolders(self, sourceFolder, dcmfolders):
+		
+		# DESCRIPTION: classify series from a single DICOM header per folder and return folders that would be discarded after conversion
+		
+		if self.pydicom is None:
+			try:
+				import pydicom
+				self.pydicom = pydicom
+			except ImportError:
+				print('pydicom not available, skipping header pre-classification')
+				return []
+		
+		toskip = []
+		for i in dcmfolders:
+			with self.tracer.span('read_dcmheader', series = i):
+				header = self.read_dcmheader(str(Path(sourceFolder, i)))
+			if header is None:
+				print('No DICOM header found for %s, leaving it to dcm2niix' % i)
+				continue
+			self.dcmheaders[i] = header
+			
+			# dcm2niix reports Siemens phase images ('P') as 'PHASE' in the json ImageType
+			imagetype = list(header['ImageType'])
+			if 'P' in imagetype and 'PHASE' not in imagetype:
+				imagetype.append('PHASE')
+			
+			data_type, task, suffix = self.classify_name(i)
+			if not self.classify_header(data_type, suffix, imagetype, header['EchoNumber'], strict = False):
+				print('Skipping %s before conversion (%s, ImageType: %s)' % (i, data_type, '\\'.join(header['ImageType'])))
+				toskip.append(i)
+		
+		return toskip
+	
 	def process_dcmfolders(self):
 		
 		# DESCRIPTION: Extract and organize information for newly converted images
 		
 		if len(self.dcmfolders)>0:			
-			self.sourcefile = {} # stores relevant info for building bids name	
+			# stores relevant info for building bids name (entries recorded in journal by an earlier run are reused)
+			self.sourcefile = {elem: dict(entry) for elem, entry in self.journal.files.items()}
+			
+			# list of json files for specific dcmfolder name (can be more than one, e.g., multi-echo)
+			json_lists = {}
+			for i in self.dcmfolders:
+				json_lists[i] = []
+				for elem in self.sesindex.match(i, '.json'):
+					if self.journal.file_state(elem) == 'classified':
+						print('%s already classified (journal)' % elem)
+					else:
+						json_lists[i].append(elem)
+			
+			# read all new sidecars at once
+			with self.tracer.span('load_sidecars') as span:
+				sidecars = self.load_sidecars([elem for i in self.dcmfolders for elem in json_lists[i]])
+				span['files'] = len(sidecars['file'])
+			
+			row = -1
 			for i in self.dcmfolders:				
 				print('Processing %s...' % i)
 				
-				tmpstr = '^(' + i + ').*(.json)$'
-				
-				# list of json files for specific dcmfolder name (can be more than one, e.g., multi-echo)
-				json_list = [elem for elem in os.listdir(self.bidsinfo['sesfolder']) if re.search(tmpstr, elem)]
-				
-				for elem in json_list:
-					
-					# dcmfolder specific dictionary
-					self.sourcefile[elem] = {}
-					self.sourcefile[elem]['oldjson'] = str(Path(self.bidsinfo['sesfolder'], elem))
-					self.sourcefile[elem]['oldnii'] = str(Path(self.bidsinfo['sesfolder'], os.path.splitext(elem)[0] + '.nii.gz')) 
-					
-					# match each dcmfolder to a bids data_type
-					for j in self.bids_data_types:
-						matches = [k for k in getattr(self, j + '_dictionary').keys() if [v for v in getattr(self, j + '_dictionary')[k] if re.search(v, elem.lower())]]
-						if matches:
-							print('%s assigned to %s' % (elem,j))							
-							# store data_type specific information in sourcefile dictionary
-							self.sourcefile[elem]['data_type'] = j							
-							if j == 'func':
-								self.sourcefile[elem]['task'] = ''.join([k for k in self.func_dictionary.keys() if [v for v in self.func_dictionary[k] if re.search(v, elem.lower())]])
-								self.sourcefile[elem]['suffix'] = 'bold'
-							elif j == 'anat':
-								self.sourcefile[elem]['suffix'] = ''.join(matches) + 'w'								
-							break # stop looping through data_types after match identified
-					
-					if 'data_type' not in self.sourcefile[elem].keys():
-						print('%s: data_type not identified, NA assigned' % elem)
-						self.sourcefile[elem]['data_type'] = 'NA'
-					
-					# load json file
-					json_fullpath = str(Path(self.bidsinfo['sesfolder'], elem))
-					f = open(json_fullpath)
-					json_data = json.load(f)
-					f.close()
-					
-					# add TaskName field to json (func only)
-					if self.sourcefile[elem]['data_type'] == 'func':
-						json_data['TaskName'] = self.sourcefile[elem]['task']
-						with open(json_fullpath, 'w') as outfile:
-							outfile.write(json.dumps(json_data, indent = 4))
-					
-					# store data_type specific information in sourcefile dictionary
-					if 'AcquisitionTime' in json_data.keys():
-						self.sourcefile[elem]['AcquisitionTime'] = json_data['AcquisitionTime']
-					else:
-						sys.exit('AcquisitionTime key not identified in %s' % elem)
+				with self.tracer.span('classify_series', series = i, files = len(json_lists[i])):
+					for elem in json_lists[i]:
+						row += 1
 						
-					if 'ImageType' in json_data.keys():
-						self.sourcefile[elem]['ImageType'] = json_data['ImageType']
-					else:
-						sys.exit('ImageType key not identified in %s' % elem)
-					
-					if 'EchoNumber' in json_data.keys():
-						self.sourcefile[elem]['EchoNumber'] = json_data['EchoNumber']
-					else:
-						self.sourcefile[elem]['EchoNumber'] = ''
-					
-					if self.sourcefile[elem]['data_type'] == 'fmap':
-						if 'PHASE' in self.sourcefile[elem]['ImageType']:
-							self.sourcefile[elem]['suffix'] = 'phasediff'
-						elif 'M' and 'NORM' in self.sourcefile[elem]['ImageType']:
-							if self.sourcefile[elem]['EchoNumber'] != '':
-								self.sourcefile[elem]['suffix'] = 'magnitude' + str(self.sourcefile[elem]['EchoNumber'])
-							else:
-								sys.exit('EchoNumber expected but not found.')
-						elif 'M' and not 'NORM' in self.sourcefile[elem]['ImageType']:
-							self.sourcefile[elem]['suffix'] = ''
-					
-					# remove anat image suffix if not ND (will result in being skipped)
-					if self.sourcefile[elem]['data_type'] == 'anat':
-						if 'ND' not in self.sourcefile[elem]['ImageType']:
+						# dcmfolder specific dictionary
+						self.sourcefile[elem] = {'series': i}
+						self.sourcefile[elem]['oldjson'] = str(Path(self.bidsinfo['workfolder'], elem))
+						self.sourcefile[elem]['oldnii'] = str(Path(self.bidsinfo['workfolder'], os.path.splitext(elem)[0] + '.nii.gz')) 
+						
+						# match each dcmfolder to a bids data_type
+						data_type, task, suffix = self.classify_name(elem)
+						self.sourcefile[elem]['data_type'] = data_type
+						if data_type == 'NA':
+							print('%s: data_type not identified, NA assigned' % elem)
+						else:
+							print('%s assigned to %s' % (elem, data_type))
+							if data_type == 'func':
+								self.sourcefile[elem]['task'] = task
+						self.sourcefile[elem]['suffix'] = suffix
+						
+						# store data_type specific information in sourcefile dictionary
+						if sidecars['AcquisitionTime'][row] is not None:
+							self.sourcefile[elem]['AcquisitionTime'] = sidecars['AcquisitionTime'][row]
+						else:
+							raise Source2RawError('AcquisitionTime key not identified in %s' % elem)
+						
+						if sidecars['ImageType'][row] is not None:
+							self.sourcefile[elem]['ImageType'] = sidecars['ImageType'][row]
+						else:
+							raise Source2RawError('ImageType key not identified in %s' % elem)
+						
+						if sidecars['EchoNumber'][row] is not None:
+							self.sourcefile[elem]['EchoNumber'] = sidecars['EchoNumber'][row]
+						else:
+							self.sourcefile[elem]['EchoNumber'] = ''
+						
+						# apply image type rules (non-ND anatomicals, fmap magnitude/phase, unknown data_type)
+						suffix = self.classify_header(self.sourcefile[elem]['data_type'], self.sourcefile[elem]['suffix'], self.sourcefile[elem]['ImageType'], self.sourcefile[elem]['EchoNumber'])
+						if not suffix and self.sourcefile[elem]['data_type'] == 'anat':
 							print('Removing suffix for %s (not ND)' % elem)
-							self.sourcefile[elem]['suffix'] = ''
-					
-					if self.sourcefile[elem]['data_type'] == 'NA':
-						print('Removing suffix for %s (unknown data_type)' % elem)
-						self.sourcefile[elem]['suffix'] = ''
+						elif self.sourcefile[elem]['data_type'] == 'NA':
+							print('Removing suffix for %s (unknown data_type)' % elem)
+						self.sourcefile[elem]['suffix'] = suffix
 		else:
-			sys.exit('dcmfolders is empty.') # something went wrong
+			raise Source2RawError('dcmfolders is empty.') # something went wrong
 		
-		# loop through all intermediate image files to get info to set final name
+		# non-ND anatomicals are not kept
 		for elem in self.sourcefile.keys():	
-			
 			if self.sourcefile[elem]['data_type'] == 'anat':
 				if 'ND' not in self.sourcefile[elem]['ImageType']:
 					self.sourcefile[elem]['suffix'] = ''
-			
+		
+		self.assign_runs()
+		
+		# record classification and run numbers, so an interrupted move can be resumed
+		for elem in self.sourcefile.keys():
+			self.sourcefile[elem].setdefault('state', 'classified')
+			self.journal.set_file(elem, self.sourcefile[elem], save = False)
+		self.journal.set_stage('classify')
+		self.journal.set_stage('assign_runs')
+		
+		# every change to the folder (data folders, TaskName in func sidecars, renames, removals), applied by move_dcmfolders
+		self.plan = self.plan_dcmfolders()
+	
+	def load_sidecars(self, elems):
+		
+		# DESCRIPTION: read json sidecars (file names in workfolder) in parallel into a column table
+		# columns: file, data (full sidecar) and the fields used for classification (None if missing)
+		
+		def read(elem):
+			with open(Path(self.bidsinfo['workfolder'], elem)) as f:
+				return json.load(f)
+		
+		if elems:
+			with ThreadPoolExecutor(max_workers = min(8, len(elems))) as pool:
+				data = list(pool.map(read, elems))
+		else:
+			data = []
+		
+		table = {'file': list(elems), 'data': data}
+		for column in ['AcquisitionTime', 'ImageType', 'EchoNumber']:
+			table[column] = [elem.get(column) for elem in data]
+		return table
+	
+	def assign_runs(self):
+		
+		# DESCRIPTION: run numbers from acquisition order, with one sort per group of images (func: same task, anat/fmap: same suffix)
+		# images acquired at the same time (e.g., echoes split into files) are ordered by EchoNumber, then file name
+		# images moved by an earlier run keep their run number (their files are named after it); new images get the numbers still free
+		
+		def echo_key(echo):
+			try:
+				return (0, float(echo), '')
+			except (TypeError, ValueError):
+				return (1, 0, str(echo))
+		
+		groups = {}
+		for elem, entry in self.sourcefile.items():
 			# skip images without a suffix
-			if not self.sourcefile[elem]['suffix']:
+			if not entry['suffix']:
+				continue
+			if entry['data_type'] == 'func':
+				groups.setdefault(('func', entry['task']), []).append(elem)
+			elif entry['data_type'] in ['anat', 'fmap']:
+				groups.setdefault(('suffix', entry['suffix']), []).append(elem)
+		
+		for group, elems in groups.items():
+			elems.sort(key = lambda elem: (self.sourcefile[elem]['AcquisitionTime'], echo_key(self.sourcefile[elem]['EchoNumber']), elem))
+			taken = set([self.sourcefile[elem]['run'] for elem in elems if self.sourcefile[elem].get('state') == 'moved'])
+			run = 0
+			for idx, elem in enumerate(elems):
+				if idx > 0 and self.sourcefile[elem]['AcquisitionTime'] == self.sourcefile[elems[idx-1]]['AcquisitionTime']:
+					print('Same acquisition time for %s and %s, runs ordered by EchoNumber/file name' % (elems[idx-1], elem))
+				if self.sourcefile[elem].get('state') == 'moved':
 					continue
-			
-			# use acquisition times for similar image type to determine run number
-			if self.sourcefile[elem]['data_type'] == 'func':
-				same_data_type = [k for k in self.sourcefile.keys() if self.sourcefile[k]['data_type']==self.sourcefile[elem]['data_type']]
-				sorted_acqtimes = sorted([self.sourcefile[k]['AcquisitionTime'] for k in same_data_type if self.sourcefile[k]['task']==self.sourcefile[elem]['task']])	
-			
-			elif self.sourcefile[elem]['data_type'] == 'fmap' or self.sourcefile[elem]['data_type'] == 'anat':
-				same_suffix = [k for k in self.sourcefile.keys() if self.sourcefile[k]['suffix']==self.sourcefile[elem]['suffix']]
-				sorted_acqtimes = sorted([self.sourcefile[k]['AcquisitionTime'] for k in same_suffix])
-			
-			# determine run number for current image
-			curr_run = [idx for idx in range(len(sorted_acqtimes)) if sorted_acqtimes[idx]==self.sourcefile[elem]['AcquisitionTime']]
-			if len(curr_run)>1:
-				print(elem) # REMOVE ME
-				sys.exit('Multiple acquisitions have same time stamp') # something went wrong
-			elif len(curr_run)==0:
-				sys.exit('No matching acquisition time stamps found') # something went wrong
-			else:
-				self.sourcefile[elem]['run'] = "%02d" % (curr_run[0]+1,)
+				run += 1
+				while "%02d" % (run,) in taken:
+					run += 1
+				self.sourcefile[elem]['run'] = "%02d" % (run,)
+			runs = [self.sourcefile[elem]['run'] for elem in elems]
+			if runs != sorted(runs):
+				print('Images converted after earlier runs were moved, runs not in acquisition order: %s' % ', '.join(['%s (run %s)' % (elem, run) for elem, run in zip(elems, runs)]))
+	
+	def plan_dcmfolders(self):
 		
-	def move_dcmfolders(self):
+		# DESCRIPTION: work out bids names for all classified images and the operations to get there, without changing anything
 		
-		# DESCRIPTION: Move dicom files to respective folders
+		plan = SessionPlan(self.bidsinfo['workfolder'])
 		
 		# run only if sourcefile is not empty
 		if len(self.sourcefile)>0:
@@ -193,14 +409,21 @@ class Source2Raw():
 			sub_elem = self.bidsinfo['sub']
 			ses_elem = self.bidsinfo['ses']
 			
+			for i in self.bids_data_types:
+				if i not in self.sesindex.dirs:
+					plan.add('mkdir', path = str(Path(self.bidsinfo['workfolder'], i)))
+			
 			for elem in self.sourcefile.keys():
 				
+				# skip images handled by an earlier (interrupted) run
+				if self.sourcefile[elem]['state'] in ['moved', 'removed']:
+					continue
+				
 				# remove image files without a suffix
 				if not self.sourcefile[elem]['suffix']:
-					print('Removing %s...' % self.sourcefile[elem]['oldjson'])
-					os.remove(self.sourcefile[elem]['oldjson'])
-					print('Removing %s...' % self.sourcefile[elem]['oldnii'])
-					os.remove(self.sourcefile[elem]['oldnii'])
+					for key in ['oldjson', 'oldnii']:
+						if os.path.basename(self.sourcefile[elem][key]) in self.sesindex:
+							plan.add('remove', elem, path = self.sourcefile[elem][key])
 					continue
 				
 				suffix_elem = self.sourcefile[elem]['suffix']
@@ -210,28 +433,80 @@ class Source2Raw():
 				# write out new file name
 				if self.sourcefile[elem]['data_type'] == 'func':
 					task_elem = '-'.join(['task', self.sourcefile[elem]['task']])
-					newjson = str(Path(self.bidsinfo['sesfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, task_elem, run_elem, suffix_elem]) + '.json'))
-					newnii = str(Path(self.bidsinfo['sesfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, task_elem, run_elem, suffix_elem]) + '.nii.gz'))
+					newjson = str(Path(self.bidsinfo['workfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, task_elem, run_elem, suffix_elem]) + '.json'))
+					newnii = str(Path(self.bidsinfo['workfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, task_elem, run_elem, suffix_elem]) + '.nii.gz'))
 				elif self.sourcefile[elem]['data_type'] == 'anat':
-					newjson = str(Path(self.bidsinfo['sesfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, suffix_elem]) + '.json'))
-					newnii = str(Path(self.bidsinfo['sesfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, suffix_elem]) + '.nii.gz'))
+					newjson = str(Path(self.bidsinfo['workfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, suffix_elem]) + '.json'))
+					newnii = str(Path(self.bidsinfo['workfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, suffix_elem]) + '.nii.gz'))
 				elif self.sourcefile[elem]['data_type'] == 'fmap':
-					newjson = str(Path(self.bidsinfo['sesfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, run_elem, suffix_elem]) + '.json'))
-					newnii = str(Path(self.bidsinfo['sesfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, run_elem, suffix_elem]) + '.nii.gz'))
+					newjson = str(Path(self.bidsinfo['workfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, run_elem, suffix_elem]) + '.json'))
+					newnii = str(Path(self.bidsinfo['workfolder'], data_type_elem, '_'.join([sub_elem, ses_elem, run_elem, suffix_elem]) + '.nii.gz'))
 				
 				self.sourcefile[elem]['newjson'] = newjson
 				self.sourcefile[elem]['newnii'] = newnii
 				
+				# add TaskName field to json (func only; sidecar rewritten only if it changes)
+				if self.sourcefile[elem]['data_type'] == 'func' and os.path.basename(self.sourcefile[elem]['oldjson']) in self.sesindex:
+					plan.add('edit_json', elem, path = self.sourcefile[elem]['oldjson'], set = {'TaskName': self.sourcefile[elem]['task']})
+				
 				# move files to appropriate location with bids structure
-				print(elem + ':')
-				os.rename(self.sourcefile[elem]['oldjson'], self.sourcefile[elem]['newjson'])
-				print('FROM: %s' % self.sourcefile[elem]['oldjson'])
-				print('TO: %s' % self.sourcefile[elem]['newjson'])
-				os.rename(self.sourcefile[elem]['oldnii'], self.sourcefile[elem]['newnii'])
-				print('FROM: %s' % self.sourcefile[elem]['oldnii'])
-				print('TO: %s' % self.sourcefile[elem]['newnii'])
+				for old, new in [('oldjson', 'newjson'), ('oldnii', 'newnii')]:
+					if os.path.basename(self.sourcefile[elem][old]) in self.sesindex:
+						plan.add('rename', elem, src = self.sourcefile[elem][old], dst = self.sourcefile[elem][new])
+					elif os.path.exists(self.sourcefile[elem][new]):
+						print('Already moved: %s' % self.sourcefile[elem][new]) # interrupted run
+					else:
+						raise Source2RawError('%s not found' % self.sourcefile[elem][old]) # something went wrong
 		else:
-			sys.exit('sourcefile is empty.') # something went wrong
+			raise Source2RawError('sourcefile is empty.') # something went wrong
+		
+		print('Plan for %s: %s' % (self.bidsinfo['workfolder'], plan.summary()))
+		return plan
+	
+	def save_plan(self):
+		
+		# DESCRIPTION: write the plan to plan_dir for a dry run (converted images and journal stay in the plan staging folder)
+		
+		fname = str(Path(self.plan_dir, '_'.join([self.inputvar['project_id'], self.inputvar['cimbi_id'], self.inputvar['mr_id']]) + '.plan.json'))
+		os.makedirs(self.plan_dir, exist_ok = True)
+		self.plan.save(fname)
+		for line in self.plan.describe():
+			print(line)
+		problems = self.plan.check()
+		for problem in problems:
+			print('PROBLEM: %s' % problem)
+		print('Plan written: %s (%s, %s problems)' % (fname, self.plan.summary(), len(problems)))
+		return fname
+	
+	def move_dcmfolders(self):
+		
+		# DESCRIPTION: Move dicom files to respective folders (apply the plan of process_dcmfolders in one step, undone on failure)
+		
+		for line in self.plan.describe():
+			print(line)
+		try:
+			self.plan.apply()
+		except ValueError as e:
+			raise Source2RawError(str(e)) # name collisions or missing files, nothing changed
+		except OSError as e:
+			raise Source2RawError('Moving files failed, changes undone: %s' % e)
+		
+		# update session index and journal once for the whole plan
+		for op in self.plan.ops:
+			if op['op'] == 'mkdir':
+				self.sesindex.dirs.add(os.path.basename(op['path']))
+			elif op['op'] == 'rename':
+				self.sesindex.rename(op['src'], op['dst'])
+				self.tracer.count('files.renamed')
+			elif op['op'] == 'remove':
+				self.sesindex.remove(os.path.basename(op['path']))
+				self.tracer.count('files.removed')
+		for elem in self.sourcefile.keys():
+			if self.sourcefile[elem]['state'] not in ['moved', 'removed']:
+				self.sourcefile[elem]['state'] = 'moved' if self.sourcefile[elem]['suffix'] else 'removed'
+				self.journal.set_file(elem, self.sourcefile[elem], save = False)
+		
+		self.journal.set_stage('move')
 		
 		print('Finished converting files to bids for %s!' % self.bidsinfo['sesfolder'])
 	
@@ -239,9 +514,16 @@ class Source2Raw():
 		
 		# DESCRIPTION: Check for presence of expected folders/files and generate ones not present but necessary to process current dataset
 		
+		# dry run: only report what a real run would make
+		if self.plan_dir:
+			for key in ['rawfolder', 'projfolder', 'subfolder']:
+				print('%s %s: %s' % (key, 'found' if os.path.isdir(self.bidsinfo[key]) else 'NOT found (not made, dry run)', self.bidsinfo[key]))
+			return
+		
 		# check that raw folder exists (make if necessary)
 		if not os.path.isdir(self.bidsinfo['rawfolder']):
 			print('Raw folder NOT found: %s. Making it...' % self.bidsinfo['rawfolder'])
+			os.makedirs(self.bidsinfo['rawfolder'], exist_ok = True)
 		else:
 			print('Raw folder found: %s' % self.bidsinfo['rawfolder'])
 		
@@ -256,7 +538,7 @@ class Source2Raw():
 		ddfile = str(Path(self.bidsinfo['projfolder'], 'dataset_description.json'))
 		if not os.path.exists(ddfile):
 			print('dataset_description NOT found: %s. Making it...' % self.bidsinfo['dataset_description'])
-			os.system('python3 /data1/patrick/SCRIPTS/py/source2raw/CreateDatasetDescription.py ' + self.bidsinfo['projfolder'])
+			DatasetDescrption(self.bidsinfo['projfolder']).generate_dataset_description()
 		else:
 			print('dataset_description.json found: %s' % self.bidsinfo['dataset_description'])
 		
@@ -278,76 +560,126 @@ class Source2Raw():
 		
 		# DESCRIPTION: Assign session folder for specific dataset
 		
-		# check whether and ses-folders in subject folder
-		subfolderList = os.listdir(self.bidsinfo['subfolder'])
-		subfolderList = [elem for elem in subfolderList if re.search('^(ses-[0-9]{3})$',elem)]
+		# look up/allocate session in participants registry (indexed, session numbers allocated atomically)
+		try:
+			self.registry = ParticipantsRegistry.for_project(self.bidsinfo['projfolder'], dry_run = bool(self.plan_dir))
+			self.bidsinfo['ses'], nsessions, created = self.registry.allocate_session(self.bidsinfo['sub'], self.inputvar['mr_id'], commit = not self.plan_dir)
+		except ValueError as e:
+			raise Source2RawError(str(e))
+		self.bidsinfo['sesfolder'] = str(Path(self.bidsinfo['subfolder'], self.bidsinfo['ses']))
 		
-		# load participants.tsv for cross-referencing
-		dd = pd.read_csv(self.bidsinfo['participants'], sep = '\t')
-		print('Reading: %s... ' % self.bidsinfo['participants'])
+		# dry run: session number not registered, no folder made
+		if self.plan_dir:
+			print('Session folder %s: %s' % ('found' if not created else 'NOT found (not made, dry run)', self.bidsinfo['sesfolder']))
+			return
 		
-		# flag lines in participants.tsv with participant id that matches input 
-		sub_matches = dd.index[dd['participant_id'] == self.bidsinfo['sub']].tolist()
+		# skip matching mr id, implies scan session already added
+		if not created:
+			print('Session folder found: %s!' % self.bidsinfo['sesfolder'])
+			os.makedirs(self.bidsinfo['sesfolder'], exist_ok = True)
 		
-		if sub_matches:
-			
-			# skip matching mr id, implies scan session already added
-			# line with matching mr id not found, build new session folder
-			if self.inputvar['mr_id'] in dd.iloc[sub_matches]['mr_id'].values:
-				
-				mr_matches = dd.index[dd['mr_id'] == self.inputvar['mr_id']].tolist()
-				
-				self.bidsinfo['ses'] = dd.iloc[mr_matches]['session_id'].values[0]
-				self.bidsinfo['sesfolder'] = str(Path(self.bidsinfo['subfolder'], self.bidsinfo['ses']))
-				print('Session folder found: %s!' % self.bidsinfo['sesfolder'])
-				
-			else:
-				
-				self.bidsinfo['ses'] = 'ses-' + f"{len(sub_matches)+1:03d}"
-				self.bidsinfo['sesfolder'] = str(Path(self.bidsinfo['subfolder'], self.bidsinfo['ses']))
-				print('Session folder NOT found: %s. Making it...' % self.bidsinfo['sesfolder'])
-				self.update_participants()
-				os.mkdir(self.bidsinfo['sesfolder'])
-				
-		# first instance of participant_id, build ses-001 folder
+		# line with matching mr id not found, build new session folder
 		else:
-			print('%s not assigned' % (self.bidsinfo['sub']))
-			self.bidsinfo['ses'] = 'ses-001'
-			self.bidsinfo['sesfolder'] = str(Path(self.bidsinfo['subfolder'], self.bidsinfo['ses']))
+			if nsessions == 0:
+				print('%s not assigned' % (self.bidsinfo['sub']))
 			print('Session folder NOT found: %s. Making it...' % self.bidsinfo['sesfolder'])
-			self.update_participants()
+			if self.export_participants:
+				self.update_participants()
 			os.mkdir(self.bidsinfo['sesfolder'])
-		
+	
 	def check_datafolder(self):
 		
 		# DESCRIPTION: check whether data folders need to be generated
 		
-		sesfolderList = os.listdir(self.bidsinfo['sesfolder'])
+		# dry run of a new session: nothing to check, images are staged
+		if not os.path.isdir(self.bidsinfo['sesfolder']) and self.plan_dir:
+			return
 		
+		# single scandir pass over session folder, reused by conversion and processing steps
+		self.sesindex = SessionIndex(self.bidsinfo['sesfolder'])
+		
+		# missing data folders are made when files are moved (part of the plan)
 		for i in self.bids_data_types:
-			if i in sesfolderList:
+			if i in self.sesindex.dirs:
 				print('Data folder found: %s' % i)
 			else:
-				print('Data folder NOT found: %s. Making it...' % i)
-				os.mkdir(Path(self.bidsinfo['sesfolder'], i))
+				print('Data folder NOT found: %s' % i)
+	
+	def check_workfolder(self):
+		
+		# DESCRIPTION: set folder where images are converted, classified and renamed
+		# default is the session folder; with scratch set, a local staging folder that is published to the session folder at the end
 		
+		# per-session journal: reruns skip work recorded as finished
+		self.journal = SessionJournal(self.bidsinfo['sesfolder'])
+		
+		if not self.scratch and not self.plan_dir:
+			self.bidsinfo['workfolder'] = self.bidsinfo['sesfolder']
+		else:
+			if self.journal.stages and not self.journal.stage_done('move'):
+				raise Source2RawError('Unfinished unstaged conversion in %s, rerun without scratch and plan' % self.bidsinfo['sesfolder'])
+			if self.plan_dir:
+				# every dry run starts from the session folder (images staged by an earlier dry run may be stale)
+				self.bidsinfo['workfolder'] = str(Path(self.plan_dir, 'staging', '_'.join([self.inputvar['project_id'], self.inputvar['cimbi_id'], self.inputvar['mr_id']])))
+				shutil.rmtree(self.bidsinfo['workfolder'], ignore_errors = True)
+			else:
+				self.bidsinfo['workfolder'] = str(Path(self.scratch, self.inputvar['project_id'], self.bidsinfo['sub'], self.bidsinfo['ses']))
+			print('Staging folder: %s' % self.bidsinfo['workfolder'])
+			for i in self.bids_data_types:
+				os.makedirs(Path(self.bidsinfo['workfolder'], i), exist_ok = True)
+			self.sesindex = SessionIndex(self.bidsinfo['workfolder'])
+			
+			# resume an interrupted staged run on this node, otherwise start from the published state
+			stagejournal = SessionJournal(self.bidsinfo['workfolder'])
+			if not stagejournal.stages:
+				stagejournal.adopt(self.journal)
+			self.journal = stagejournal
+		
+		if self.journal.stages:
+			print('Resuming from journal: %s (finished: %s)' % (self.journal.fname, ', '.join(self.journal.stages.keys())))
+		self.journal.info['mr_id'] = self.inputvar['mr_id']
+		self.journal.set_stage('resolve', mr_id = self.inputvar['mr_id'])
+	
+	def publish_workfolder(self):
+		
+		# DESCRIPTION: publish staged bids files into the session folder in one bulk step, then remove staging folder
+		
+		if self.bidsinfo['workfolder'] == self.bidsinfo['sesfolder']:
+			return
+		
+		try:
+			published = publish_tree(self.bidsinfo['workfolder'], self.bidsinfo['sesfolder'], self.bids_data_types)
+		except FileExistsError as e:
+			raise Source2RawError('%s (staging folder kept: %s)' % (e.strerror, self.bidsinfo['workfolder']))
+		self.tracer.count('files.published', len(published))
+		
+		# journal now describes the published files and lives with the session
+		for elem in self.sourcefile.keys():
+			for key in ['newjson', 'newnii']:
+				if self.sourcefile[elem].get(key) in published:
+					self.sourcefile[elem][key] = published[self.sourcefile[elem][key]]
+			self.journal.set_file(elem, self.sourcefile[elem], save = False)
+		self.journal.fname = str(Path(self.bidsinfo['sesfolder'], os.path.basename(self.journal.fname)))
+		self.journal.set_stage('publish', files = len(published))
+		
+		shutil.rmtree(self.bidsinfo['workfolder'])
+		print('Removed staging folder: %s' % self.bidsinfo['workfolder'])
+	
 	def update_participants(self):
 		
-		# DESCRIPTION: update participants.tsv file
+		# DESCRIPTION: update participants.tsv file (exported from participants registry)
 		
-		dd = pd.read_csv(self.bidsinfo['participants'], sep = '\t')
-		dd = dd.append({'participant_id': self.bidsinfo['sub'],'session_id': self.bidsinfo['ses'], 'mr_id': self.inputvar['mr_id']}, ignore_index = True)
-		dd.to_csv(self.bidsinfo['participants'], sep = '\t', index = False)
-		print('%s file updated!' % self.bidsinfo['participants'])
+		self.registry.export_tsv(self.bidsinfo['participants'])
 	
 	def check_mrid(self):
 		
-		sourceDir = os.listdir(Path(self.mrsource, self.mrscanner))
-		mr_matches = [idx for idx in sourceDir if re.search('^' + self.inputvar['mr_id'], idx)]
+		# DESCRIPTION: resolve mr_id (prefix) to a source session folder using cached scanner index
+		
+		mr_matches = MRrawIndex.for_scanner(Path(self.mrsource, self.mrscanner)).resolve(self.inputvar['mr_id'])
 		if len(mr_matches) == 0:
-			sys.exit('No MR IDs in source match input (%s)' % self.inputvar['mr_id'])
+			raise Source2RawError('No MR IDs in source match input (%s)' % self.inputvar['mr_id'])
 		elif len(mr_matches) > 1:
-			sys.exit('Specified MR ID ambiguous...%s matches' % len(mr_matches))
+			raise Source2RawError('Specified MR ID ambiguous...%s matches' % len(mr_matches))
 		else:
 			mr_id_full = ''.join(mr_matches)
 			if self.inputvar['mr_id'] != mr_id_full:
@@ -356,34 +688,343 @@ class Source2Raw():
 			else:
 				print('mr_id: %s verified!' % self.inputvar['mr_id'])
 	
+	@contextmanager
+	def project_lock(self):
+		
+		# DESCRIPTION: hold an exclusive lock on the project while project-level files/folders are checked or updated
+		# (participants.tsv, ses-folder numbering, conversion cache, scan index), so concurrent conversions into the same project do not race;
+		# sqlite databases under <project>/.source2raw are only accessed with this lock held (sqlite locking is unreliable on network filesystems)
+		
+		# dry run: nothing in the raw folder is changed
+		if self.plan_dir:
+			yield
+			return
+		
+		os.makedirs(self.bidsinfo['rawfolder'], exist_ok = True)
+		if self.lease_locks:
+			with hold(self.bidsinfo['projlock'] + '.lease', ttl = 600, poll = 0.5):
+				yield
+			return
+		with open(self.bidsinfo['projlock'], 'a') as lockfile:
+			fcntl.flock(lockfile, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lockfile, fcntl.LOCK_UN)
+	
 	def run_all(self):
 		
 		# DESCRIPTION: "all-in-one" function that executes relevant methods in sequence
-		self.check_mrid()
-		self.check_rawfolder()
-		self.check_sesfolder()
-		self.check_datafolder()
-		self.convert_source_inputs()
-		self.process_dcmfolders()
-		self.move_dcmfolders()
+		tracefile = None
+		if self.trace_dir:
+			tracefile = str(Path(self.trace_dir, '_'.join([self.inputvar['project_id'], self.inputvar['cimbi_id'], self.inputvar['mr_id']]) + '.jsonl'))
+		self.tracer = Tracer(tracefile, session = self.inputvar['mr_id'], profile = self.profile, profile_memory = self.profile_memory)
+		
+		try:
+			with self.tracer.span('run_all', project_id = self.inputvar['project_id'], cimbi_id = self.inputvar['cimbi_id']):
+				self.run_stage('check_mrid')
+				self.tracer.session = self.inputvar['mr_id']
+				with self.project_lock():
+					self.run_stage('check_rawfolder')
+					self.run_stage('check_sesfolder')
+					self.run_stage('check_datafolder')
+				self.run_stage('check_workfolder')
+				self.run_stage('convert_source_inputs')
+				self.run_stage('process_dcmfolders')
+				if self.plan_dir:
+					self.save_plan()
+					return
+				self.run_stage('move_dcmfolders')
+				self.run_stage('publish_workfolder')
+				self.run_stage('update_conversion_cache')
+				self.run_stage('update_scan_index')
+		finally:
+			if tracefile:
+				print('%s written!' % self.tracer.write_summary(os.path.splitext(tracefile)[0] + '.summary.json'))
+	
+	def run_stage(self, stage):
+		
+		# DESCRIPTION: run one step of run_all, timed by the tracer
+		
+		for lease in self.leases:
+			if not lease.check():
+				raise Source2RawError('Lease lost before %s, conversion aborted (taken over by %s): %s' % (stage, lease.holder(), lease.fname))
+		with self.tracer.span(stage, stage = True):
+			return getattr(self, stage)()
+	
+	def run_dcm2niix(self, dcmfolder, sourceFolder):
+		
+		# DESCRIPTION: convert one source series folder with dcm2niix (no shell), capturing exit code and output
 		
+		# with a separate compression stage, dcm2niix writes uncompressed .nii
+		compress = 'n' if self.gz_threads > 1 else 'y'
+		dcm2niix_cmd = [self.d2n_path, '-o', self.bidsinfo['workfolder'], '-z', compress, '-f', dcmfolder, str(Path(sourceFolder, dcmfolder))]
+		with self.tracer.span('dcm2niix', series = dcmfolder) as span:
+			
+			# DICOM bytes read (session throughput, used by the batch/watch scheduler to detect a saturated archive)
+			with os.scandir(Path(sourceFolder, dcmfolder)) as it:
+				span['bytes'] = sum([entry.stat().st_size for entry in it if entry.is_file()])
+			try:
+				proc = subprocess.run(dcm2niix_cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+			except OSError as e:
+				span['returncode'] = -1
+				return {'returncode': -1, 'stdout': '', 'stderr': str(e)}
+			span['returncode'] = proc.returncode
+			span['files'] = len(re.findall('Convert [0-9]+ DICOM as ', proc.stdout))
+		return {'returncode': proc.returncode, 'stdout': proc.stdout, 'stderr': proc.stderr}
+	
+	def source_changed(self, sourceFolder, dcmfolder):
+		
+		# DESCRIPTION: whether the DICOM files of a series converted by an earlier run changed since (files added/removed/modified;
+		# with cache_verify also their content); series recorded without fingerprint (older journals) count as unchanged
+		
+		recorded = self.journal.source(dcmfolder)
+		if recorded is None:
+			return False
+		if recorded['key'] != self.series_key(sourceFolder, dcmfolder):
+			print('Source series changed since conversion: %s' % dcmfolder)
+			return True
+		if self.cache_verify and recorded.get('content') and recorded['content'] != series_content_hash(str(Path(sourceFolder, dcmfolder))):
+			print('Source series content changed since conversion: %s' % dcmfolder)
+			return True
+		return False
+	
+	def discard_series(self, dcmfolder):
+		
+		# DESCRIPTION: remove outputs of a series converted by an earlier run (bids files and intermediate images), so it is converted again
+		
+		for elem, entry in self.journal.discard_series(dcmfolder, save = False).items():
+			for key in ['newjson', 'newnii', 'oldjson', 'oldnii']:
+				if entry.get(key) and os.path.exists(entry[key]):
+					print('Removing outdated output %s...' % entry[key])
+					os.remove(entry[key])
+		for fname in self.sesindex.match(dcmfolder):
+			print('Removing outdated output %s...' % fname)
+			os.remove(Path(self.bidsinfo['workfolder'], fname))
+			self.sesindex.remove(fname)
+		self.journal.save()
+	
+	def remove_partial(self, dcmfolder):
+		
+		# DESCRIPTION: remove output files of a series whose conversion did not finish (still in the work folder, named after the series)
+		
+		for fname in self.sesindex.match(dcmfolder):
+			print('Removing partial output %s...' % fname)
+			os.remove(Path(self.bidsinfo['workfolder'], fname))
+			self.sesindex.remove(fname)
+	
+	def series_key(self, sourceFolder, dcmfolder):
+		
+		# DESCRIPTION: conversion cache key: SeriesInstanceUID (source path if header not read) + fingerprint of DICOM files
+		
+		if dcmfolder not in self.series_keys:
+			uid = self.dcmheaders.get(dcmfolder, {}).get('SeriesInstanceUID') or str(Path(sourceFolder, dcmfolder))
+			self.series_keys[dcmfolder] = ConversionCache.make_key(uid, series_fingerprint(str(Path(sourceFolder, dcmfolder))))
+		return self.series_keys[dcmfolder]
+	
+	def update_conversion_cache(self):
+		
+		# DESCRIPTION: record final bids outputs per source series in conversion cache
+		# only series converted in this run: their key is the fingerprint taken before conversion, so it always describes the outputs
+		
+		if not self.use_cache:
+			return
+		
+		sourceFolder = str(Path(self.mrsource, self.mrscanner, self.inputvar['mr_id']))
+		outputs = {}
+		for elem, entry in self.sourcefile.items():
+			if entry.get('series') in self.converted_series and entry['state'] in ['moved', 'removed']:
+				outputs.setdefault(entry['series'], {})[elem] = entry
+		
+		# content hashes (verify mode) are taken before locking, so the lock is held only for the database update
+		series = [i for i in outputs.keys() if os.path.isdir(Path(sourceFolder, i))]
+		contents = {i: series_content_hash(str(Path(sourceFolder, i))) if self.cache_verify else None for i in series}
+		with self.project_lock():
+			cache = ConversionCache.for_project(self.bidsinfo['projfolder'], self.cache_size)
+			for i in series:
+				cache.store(self.series_key(sourceFolder, i), i, self.bidsinfo['sesfolder'], outputs[i], contents[i])
+			cache.evict()
+			cache.close()
+		print('Conversion cache updated: %s series' % len(outputs))
+	
+	def update_scan_index(self):
+		
+		# DESCRIPTION: record bids files of this session in the project scan index and write scans.tsv/sessions.tsv
+		# sha256 of files already indexed with the same size and mtime is reused (only new or changed files are read)
+		# the index is read and updated, and the tsv files exported, under the project lock (files are hashed in between, unlocked)
+		
+		indexed = {}
+		if self.index_hash:
+			with self.project_lock():
+				index = ScanIndex.for_project(self.bidsinfo['projfolder'])
+				indexed = index.file_hashes(self.bidsinfo['sub'], self.bidsinfo['ses'])
+				index.close()
+		scans = []
+		for elem, entry in self.sourcefile.items():
+			if entry['state'] != 'moved':
+				continue
+			filename = os.path.relpath(entry['newnii'], self.bidsinfo['projfolder'])
+			stat = os.stat(entry['newnii'])
+			sha256 = ''
+			if self.index_hash:
+				size, mtime, sha256 = indexed.get(filename, (None, None, ''))
+				if (size, mtime) != (stat.st_size, stat.st_mtime_ns) or not sha256:
+					sha256 = file_sha256(entry['newnii'])
+					self.tracer.count('files.hashed')
+			scans.append({
+					'filename': filename,
+					'sidecar': os.path.relpath(entry['newjson'], self.bidsinfo['projfolder']),
+					'participant_id': self.bidsinfo['sub'],
+					'session_id': self.bidsinfo['ses'],
+					'data_type': entry['data_type'],
+					'task': entry.get('task', ''),
+					'run': entry.get('run', ''),
+					'suffix': entry['suffix'],
+					'acq_date': self.dcmheaders.get(entry.get('series'), {}).get('AcquisitionDate', entry.get('AcquisitionDate', '')),
+					'acq_time': entry['AcquisitionTime'],
+					'echo': str(entry['EchoNumber']),
+					'size': stat.st_size,
+					'mtime': stat.st_mtime_ns,
+					'sha256': sha256,
+					'source_series': entry.get('series', '')})
+		
+		with self.project_lock():
+			index = ScanIndex.for_project(self.bidsinfo['projfolder'])
+			index.update_session(self.bidsinfo['sub'], self.bidsinfo['ses'], self.inputvar['mr_id'], scans)
+			print('Scan index updated: %s scans' % len(scans))
+			print('%s written!' % index.export_scans_tsv(self.bidsinfo['sub'], self.bidsinfo['ses']))
+			print('%s written!' % index.export_sessions_tsv(self.bidsinfo['sub']))
+			index.close()
+	
+	def compress_series(self, dcmfolder, d2n_stdout, pool):
+		
+		# DESCRIPTION: gzip the .nii outputs of one converted series (blocks compressed in parallel on pool)
+		
+		# output names reported by dcm2niix ('Convert 176 DICOM as /path/T1_MPRAGE_0002 (...)'), otherwise look for them
+		niilist = [elem + '.nii' for elem in re.findall('Convert [0-9]+ DICOM as (.+) \\(', d2n_stdout) if os.path.exists(elem + '.nii')]
+		if not niilist:
+			niilist = [str(Path(self.bidsinfo['workfolder'], fname)) for fname in os.listdir(self.bidsinfo['workfolder']) if fname.startswith(dcmfolder) and fname.endswith('.nii')]
+		with self.tracer.span('compress', series = dcmfolder, files = len(niilist)) as span:
+			span['bytes'] = sum([os.path.getsize(niifile) for niifile in niilist])
+			for niifile in niilist:
+				compress_file(niifile, level = self.gz_level, pool = pool, threads = self.gz_threads)
+		return niilist
+	
 	def convert_source_inputs(self):
 		
 		# DESCRIPTION: identify source folders to be converted to raw files
 		sourceFolder = str(Path(self.mrsource, self.mrscanner, self.inputvar['mr_id']))
-		sourceDir = os.listdir(sourceFolder)
-		dcmfolders = [i for i in sourceDir if re.search('^(EP2D|T1|T2|GRE).*([0-9]{4})', i)]
-		d2n_path = 'dcm2niix'
-		toremove = []
-		for i in dcmfolders:
-			imgmatch = [fname for fname in os.listdir(self.bidsinfo['sesfolder']) if re.search('^(' + i + '.*.nii.gz)$', fname)]
+		with self.tracer.span('list_source', files = 0) as span:
+			sourceDir = sorted(os.listdir(sourceFolder))
+			span['files'] = len(sourceDir)
+		dcmfolders = [i for i in sourceDir if self.classifier.is_source_series(i)]
+		toconvert = []
+		toremove = self.prescan_dcmfolders(sourceFolder, dcmfolders) if self.prescan else []
+		for i in toremove:
+			self.journal.set_series(i, 'skipped', save = False)
+		for i in [elem for elem in dcmfolders if elem not in toremove]:
+			if self.journal.series_state(i) == 'converted':
+				if not self.source_changed(sourceFolder, i):
+					print('Already converted (journal): %s! Skipping dcm2niix...' % i)
+					continue
+				self.discard_series(i)
+			
+			# conversion was interrupted or failed (dcm2niix may write files before exiting non-zero), discard partial outputs
+			if self.journal.series_state(i) in ['converting', 'failed']:
+				self.remove_partial(i)
+			
+			imgmatch = self.sesindex.match(i, '.nii.gz')
 			if imgmatch:
 				print('Existing match found: %s! Skipping dcm2niix...' % i)
+				self.journal.set_series(i, 'converted', save = False)
 			else:
-				print('Converting: %s ' % i)
-				dcm2niix_cmd = d2n_path + ' -o ' + self.bidsinfo['sesfolder'] + ' -z y -f ' + i + ' ' + str(Path(sourceFolder,i))
-				os.system(dcm2niix_cmd)
+				toconvert.append(i)
+		
+		# series converted before with identical DICOM files: reuse bids outputs recorded in conversion cache
+		# (dry run: only if the project has a cache, which is opened read-only)
+		if self.use_cache and toconvert and (not self.plan_dir or os.path.isfile(ConversionCache.project_dbfile(self.bidsinfo['projfolder']))):
+			keys = {i: self.series_key(sourceFolder, i) for i in toconvert}
+			with self.project_lock():
+				cache = ConversionCache.for_project(self.bidsinfo['projfolder'], self.cache_size, readonly = bool(self.plan_dir))
+				found = {i: cache.lookup(keys[i], self.bidsinfo['sesfolder'], str(Path(sourceFolder, i)), verify = self.cache_verify) for i in toconvert}
+				cache.close()
+			for i in list(toconvert):
+				outputs = found[i]
+				self.tracer.count('cache.hits' if outputs is not None else 'cache.misses')
+				if outputs is not None:
+					print('Conversion cache hit: %s! Reusing %s outputs...' % (i, len(outputs)))
+					for elem, entry in outputs.items():
+						self.journal.set_file(elem, entry, save = False)
+					self.journal.set_series(i, 'converted', save = False)
+					self.journal.set_source(i, self.series_key(sourceFolder, i), save = False)
+					toconvert.remove(i)
+		
+		# fingerprint of the DICOM files as converted (a later run reconverts the series if they change)
+		for i in toconvert:
+			self.journal.set_series(i, 'converting', save = False)
+			self.journal.set_source(i, self.series_key(sourceFolder, i), series_content_hash(str(Path(sourceFolder, i))) if self.cache_verify else None, save = False)
+		self.journal.save()
+		self.converted_series = list(toconvert)
 		
+		# convert series in parallel (each series is written to its own output files, so results are identical to converting one by one)
+		# with gz_threads > 1, compression of converted series overlaps with conversion of the next ones
+		self.d2n_results = {}
+		failed = []
+		if toconvert:
+			print('Converting %s series (%s workers)...' % (len(toconvert), self.d2n_workers))
+			compress = self.gz_threads > 1
+			gzpool = ThreadPoolExecutor(max_workers = self.gz_threads) if compress else None
+			filepool = ThreadPoolExecutor(max_workers = 2) if compress else None
+			gzfutures = {}
+			try:
+				with ThreadPoolExecutor(max_workers = max(1, self.d2n_workers)) as pool:
+					futures = {pool.submit(self.run_dcm2niix, i, sourceFolder): i for i in toconvert}
+					for future in as_completed(futures):
+						i = futures[future]
+						self.d2n_results[i] = future.result()
+						print('Converting: %s (exit code %s)' % (i, self.d2n_results[i]['returncode']))
+						if self.d2n_results[i]['stdout']:
+							print(self.d2n_results[i]['stdout'].rstrip())
+						if self.d2n_results[i]['returncode'] == 0:
+							if compress:
+								gzfutures[filepool.submit(self.compress_series, i, self.d2n_results[i]['stdout'], gzpool)] = i
+							else:
+								self.journal.set_series(i, 'converted')
+						else:
+							print('dcm2niix failed for %s: %s' % (i, self.d2n_results[i]['stderr'].strip()))
+							self.journal.set_series(i, 'failed')
+							failed.append(i)
+							if self.d2n_policy == 'failfast':
+								pool.shutdown(wait = True, cancel_futures = True)
+								raise Source2RawError('dcm2niix failed for %s (exit code %s)' % (i, self.d2n_results[i]['returncode']))
+				
+				# series count as converted once compressed
+				for future in as_completed(gzfutures):
+					i = gzfutures[future]
+					try:
+						niilist = future.result()
+						print('Compressed: %s (%s files)' % (i, len(niilist)))
+						self.journal.set_series(i, 'converted')
+					except OSError as e:
+						print('Compression failed for %s: %s' % (i, e))
+						self.journal.set_series(i, 'failed')
+						failed.append(i)
+						if self.d2n_policy == 'failfast':
+							raise Source2RawError('Compression failed for %s' % i)
+			finally:
+				if compress:
+					filepool.shutdown(wait = True, cancel_futures = True)
+					gzpool.shutdown(wait = True)
+			
+			# pick up newly written files in one pass
+			self.sesindex.refresh()
+			if failed:
+				print('Continuing without %s failed series: %s' % (len(failed), ', '.join(sorted(failed))))
+				for i in failed:
+					self.remove_partial(i)
+			toremove.extend(failed)
+		
+		self.journal.set_stage('convert')
 		print('Done converting source input folders!')
 		self.dcmfolders = {}
 		self.dcmfolders = [elem for elem in dcmfolders if elem not in toremove]
@@ -394,16 +1035,38 @@ class Source2Raw():
 		
 		column_set = ['participant_id', 'session_id', 'mr_id']
 		fname = str(Path(self.bidsinfo['projfolder'], 'participants.tsv'))
-		df = pd.DataFrame(columns=column_set)
-		df.to_csv(fname, sep = '\t', index = False)
+		with open(fname, 'w', newline = '') as f:
+			csv.writer(f, delimiter = '\t', lineterminator = '\n').writerow(column_set)
+
+def main(argv = None):
 	
-if __name__ == '__main__':
+	# DESCRIPTION: command line entry point; returns exit code (errors are reported, not raised)
+	
+	parser = argparse.ArgumentParser(description = 'Convert one MR session to BIDS.')
+	for elem in ['raw_id', 'project_id', 'cimbi_id', 'mr_id']:
+		parser.add_argument(elem)
+	parser.add_argument('--mrsource', default = Source2Raw.mrsource, help = 'MRraw folder with one subfolder per scanner')
+	parser.add_argument('--scratch', help = 'convert in this local folder and publish the finished session to the raw folder')
+	parser.add_argument('--trace', help = 'write JSON-lines events and a summary to this folder')
+	parser.add_argument('--profile', default = '', help = 'comma separated stages/spans to run under cProfile, one at a time (requires --trace)')
+	parser.add_argument('--plan', help = 'dry run: convert into <folder>/staging and write the planned file operations to this folder; the raw folder is not changed')
+	args = parser.parse_args(argv)
 	
-	self = Source2Raw()
-	self.run_all()
-	print('Input data: %s %s %s' % (self.inputvar['project_id'], self.inputvar['cimbi_id'], self.inputvar['mr_id']))
+	try:
+		s2r = Source2Raw(args.raw_id, args.project_id, args.cimbi_id, args.mr_id, mrsource = args.mrsource, scratch = args.scratch,
+				trace_dir = args.trace, profile = [elem for elem in args.profile.split(',') if elem], plan_dir = args.plan)
+		s2r.run_all()
+	except Source2RawError as e:
+		print('ERROR: %s' % e, file = sys.stderr)
+		return 1
+	print('Input data: %s %s %s' % (s2r.inputvar['project_id'], s2r.inputvar['cimbi_id'], s2r.inputvar['mr_id']))
 	print('Done!')
+	return 0
+
+if __name__ == '__main__':
 	
+	sys.exit(main())
+
 #for i in range(1,3):
 #	if i == 1:
 #		raw_id = '/mrdata/patrick/raw'
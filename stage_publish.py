@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import errno
+import shutil
+import filecmp
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+def copy_file(src, dst):
+	
+	# DESCRIPTION: copy file contents in the kernel (copy_file_range, then sendfile); plain read/write as last resort
+	
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		nbytes = os.fstat(fsrc.fileno()).st_size
+		offset = 0
+		try:
+			while offset < nbytes:
+				n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), nbytes - offset)
+				if n == 0:
+					break
+				offset += n
+		except (AttributeError, OSError):
+			# copy_file_range not available or not supported between these filesystems
+			try:
+				while offset < nbytes:
+					n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, nbytes - offset)
+					if n == 0:
+						break
+					offset += n
+			except (AttributeError, OSError):
+				fsrc.seek(offset)
+				fdst.seek(offset)
+				shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+		fdst.flush()
+		os.fsync(fdst.fileno())
+
+def link_exclusive(src, dst):
+	
+	# DESCRIPTION: give file src the additional name dst, failing if dst exists; filesystems without hard links fall back to
+	# rename (targets are checked by publish_tree before)
+	
+	try:
+		os.link(src, dst)
+		return True
+	except OSError as e:
+		if e.errno not in [errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP]:
+			raise
+	if os.path.exists(dst):
+		raise FileExistsError(errno.EEXIST, 'File exists', dst)
+	os.rename(src, dst)
+	return False
+
+def publish_file(src, dst):
+	
+	# DESCRIPTION: move one file into the raw tree; readers only ever see the complete file and an existing file is never replaced
+	# same filesystem: hard link + unlink; otherwise copy to a temporary name next to the target, fsync and link
+	# (link fails if the target exists, unlike rename)
+	
+	try:
+		if link_exclusive(src, dst):
+			os.remove(src)
+		return 0
+	except OSError as e:
+		if e.errno != errno.EXDEV: # different filesystems
+			raise
+	tmpname = str(Path(os.path.dirname(dst), '.' + os.path.basename(dst) + '.part'))
+	try:
+		copy_file(src, tmpname)
+		link_exclusive(tmpname, dst)
+	finally:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+	nbytes = os.path.getsize(dst)
+	os.remove(src)
+	return nbytes
+
+def fsync_dir(folder):
+	
+	fd = os.open(folder, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def publish_tree(workfolder, sesfolder, subfolders, max_workers = 4):
+	
+	# DESCRIPTION: publish all files in the given subfolders (anat/func/fmap) of a staging folder into the session folder
+	# returns {staged path: published path}
+	
+	pairs = []
+	for sub in subfolders:
+		if not os.path.isdir(Path(workfolder, sub)):
+			continue
+		os.makedirs(Path(sesfolder, sub), exist_ok = True)
+		with os.scandir(Path(workfolder, sub)) as it:
+			for entry in it:
+				if entry.is_file():
+					pairs.append((entry.path, str(Path(sesfolder, sub, entry.name))))
+	
+	# refuse before anything is published if a staged file would replace a different file in the session folder
+	# (an identical one is left by a publish interrupted after linking, the staged copy is dropped)
+	existing = []
+	identical = []
+	for src, dst in pairs:
+		if os.path.exists(dst):
+			if filecmp.cmp(src, dst, shallow = False):
+				identical.append((src, dst))
+			else:
+				existing.append(dst)
+	if existing:
+		raise FileExistsError(errno.EEXIST, 'Not published, %s file(s) already in session folder: %s' % (len(existing), ', '.join(sorted(existing))))
+	for src, dst in identical:
+		os.remove(src)
+	
+	with ThreadPoolExecutor(max_workers = max_workers) as pool:
+		copied = list(pool.map(lambda pair: publish_file(*pair), [pair for pair in pairs if pair not in identical]))
+	
+	# make the new directory entries durable
+	for sub in subfolders:
+		if os.path.isdir(Path(sesfolder, sub)):
+			fsync_dir(str(Path(sesfolder, sub)))
+	
+	print('Published %s files (%s MB copied) to %s' % (len(pairs), round(sum(copied) / 1e6, 1), sesfolder))
+	return dict(pairs)
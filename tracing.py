@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import os
+import sys
+import json
+import math
+import time
+import threading
+import contextlib
+from pathlib import Path
+
+from fsutil import atomic_write_json, read_json
+
+class Tracer():
+	
+	def __init__(self, eventfile = None, session = None, profile = None, profile_memory = False, profiledir = None):
+		
+		# DESCRIPTION: timing of stages and per-series operations: JSON-lines events (eventfile) plus counters and histograms for a summary
+		# profile: span names (e.g. 'process_dcmfolders') run under cProfile; profile_memory: same spans also under tracemalloc
+		# profilers are process-wide: one span is profiled at a time, a profiled span started while another one runs (nested, or in another
+		# thread, e.g. dcm2niix with d2n_workers > 1) runs unprofiled and is counted as <name>.profile_skipped
+		# without eventfile, only the in-memory summary is kept (cheap enough to be always on)
+		
+		self.eventfile = eventfile
+		self.session = session
+		self.profile = set(profile or [])
+		self.profile_memory = profile_memory
+		self.profiledir = profiledir or (os.path.dirname(eventfile) if eventfile else '.')
+		self.counters = {}
+		self.histograms = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.profiling = False
+		self.tracemalloc_started = False
+		if self.eventfile:
+			os.makedirs(os.path.dirname(os.path.abspath(self.eventfile)), exist_ok = True)
+	
+	def emit(self, event):
+		
+		# DESCRIPTION: append one event (one line, written in a single call so concurrent writers do not interleave)
+		
+		if not self.eventfile:
+			return
+		event = dict(event, ts = round(time.time(), 6), pid = os.getpid(), session = self.session)
+		line = json.dumps(event, default = str) + '\n'
+		with self.lock:
+			with open(self.eventfile, 'a') as f:
+				f.write(line)
+	
+	def count(self, name, n = 1):
+		
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+	
+	def observe(self, name, value):
+		
+		# DESCRIPTION: add value to histogram name (count, sum, min, max and power-of-two buckets, so histograms of many sessions can be merged)
+		
+		bucket = str(math.ceil(math.log2(value))) if value > 0 else '-inf'
+		with self.lock:
+			hist = self.histograms.setdefault(name, {'count': 0, 'sum': 0, 'min': value, 'max': value, 'buckets': {}})
+			hist['count'] += 1
+			hist['sum'] += value
+			hist['min'] = min(hist['min'], value)
+			hist['max'] = max(hist['max'], value)
+			hist['buckets'][bucket] = hist['buckets'].get(bucket, 0) + 1
+	
+	@contextlib.contextmanager
+	def span(self, name, **fields):
+		
+		# DESCRIPTION: time a block; the yielded dict takes extra fields (bytes, files, returncode, ...), numeric ones are also counted
+		# e.g. with tracer.span('dcm2niix', series = i) as span: ...; span['bytes'] = n
+		
+		stack = self.local.__dict__.setdefault('stack', [])
+		parent = stack[-1] if stack else None
+		stack.append(name)
+		profiler = self.start_profile(name) if name in self.profile else None
+		
+		fields = dict(fields)
+		error = None
+		start = time.perf_counter()
+		try:
+			yield fields
+		except BaseException as e:
+			error = '%s: %s' % (type(e).__name__, e)
+			raise
+		finally:
+			duration = time.perf_counter() - start
+			stack.pop()
+			if profiler is not None:
+				fields.update(self.stop_profile(name, profiler))
+			self.observe(name + '.seconds', duration)
+			self.count(name + '.calls')
+			for key, val in fields.items():
+				if key in ['bytes', 'files'] and isinstance(val, (int, float)) and not isinstance(val, bool):
+					self.count('%s.%s' % (name, key), val)
+			event = dict(fields, event = name, duration = round(duration, 6), parent = parent)
+			if error:
+				event['error'] = error
+				self.count(name + '.errors')
+			self.emit(event)
+	
+	def start_profile(self, name):
+		
+		# DESCRIPTION: claim the profiler slot and start cProfile (and tracemalloc, unless already tracing); None if another span holds it
+		
+		import cProfile
+		import tracemalloc
+		with self.lock:
+			if self.profiling:
+				self.counters[name + '.profile_skipped'] = self.counters.get(name + '.profile_skipped', 0) + 1
+				return None
+			self.profiling = True
+		profiler = cProfile.Profile()
+		try:
+			if self.profile_memory:
+				if tracemalloc.is_tracing():
+					tracemalloc.reset_peak()
+				else:
+					tracemalloc.start()
+					self.tracemalloc_started = True
+			profiler.enable()
+		except BaseException:
+			self.release_profile()
+			raise
+		return profiler
+	
+	def stop_profile(self, name, profiler):
+		
+		try:
+			profiler.disable()
+			fields = {'profile': self.dump_profile(name, profiler)}
+			if self.profile_memory:
+				fields.update(self.memory_usage())
+			return fields
+		finally:
+			self.release_profile()
+	
+	def release_profile(self):
+		
+		import tracemalloc
+		if self.tracemalloc_started:
+			tracemalloc.stop()
+			self.tracemalloc_started = False
+		self.profiling = False
+	
+	def dump_profile(self, name, profiler):
+		
+		fname = str(Path(self.profiledir, '%s_%s_%s.prof' % (self.session or 'source2raw', name, os.getpid())))
+		os.makedirs(self.profiledir, exist_ok = True)
+		profiler.dump_stats(fname)
+		return fname
+	
+	def memory_usage(self, top = 5):
+		
+		# DESCRIPTION: peak traced memory and largest allocation sites of a profiled span
+		
+		import cProfile
+		import tracemalloc
+		current, peak = tracemalloc.get_traced_memory()
+		snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, cProfile.__file__), tracemalloc.Filter(False, tracemalloc.__file__)])
+		stats = snapshot.statistics('lineno')[:top]
+		return {'mem_peak': peak, 'mem_top': ['%s: %s' % (stat.traceback, stat.size) for stat in stats]}
+	
+	def summary(self):
+		
+		with self.lock:
+			return {'session': self.session, 'counters': dict(self.counters), 'histograms': {name: summarize_histogram(hist) for name, hist in self.histograms.items()}}
+	
+	def write_summary(self, fname):
+		
+		atomic_write_json(fname, self.summary(), indent = 1)
+		return fname
+
+def summarize_histogram(hist):
+	
+	# DESCRIPTION: add mean and approximate percentiles (upper bound of bucket) to a histogram
+	
+	hist = dict(hist, buckets = dict(hist['buckets']))
+	hist['mean'] = hist['sum'] / hist['count'] if hist['count'] else 0
+	ordered = sorted(hist['buckets'].items(), key = lambda elem: float(elem[0]))
+	for q in [50, 90, 99]:
+		n = 0
+		for bucket, count in ordered:
+			n += count
+			if n >= q / 100 * hist['count']:
+				hist['p%s' % q] = min(hist['max'], 2 ** float(bucket))
+				break
+	return hist
+
+def merge_summaries(summaries):
+	
+	# DESCRIPTION: combine summaries of several sessions (e.g. one per batch job) into one
+	
+	merged = {'sessions': 0, 'counters': {}, 'histograms': {}}
+	for summary in summaries:
+		merged['sessions'] += 1
+		for name, val in summary['counters'].items():
+			merged['counters'][name] = merged['counters'].get(name, 0) + val
+		for name, hist in summary['histograms'].items():
+			total = merged['histograms'].setdefault(name, {'count': 0, 'sum': 0, 'min': hist['min'], 'max': hist['max'], 'buckets': {}})
+			total['count'] += hist['count']
+			total['sum'] += hist['sum']
+			total['min'] = min(total['min'], hist['min'])
+			total['max'] = max(total['max'], hist['max'])
+			for bucket, count in hist['buckets'].items():
+				total['buckets'][bucket] = total['buckets'].get(bucket, 0) + count
+	merged['histograms'] = {name: summarize_histogram(hist) for name, hist in merged['histograms'].items()}
+	return merged
+
+if __name__ == '__main__':
+	
+	# merge per-session summaries and print time per span, e.g. python3 tracing.py traces/*.summary.json
+	
+	summaries = [read_json(fname) for fname in sys.argv[1:] if fname.endswith('.summary.json')]
+	if not summaries:
+		sys.exit('No *.summary.json files given')
+	merged = merge_summaries(summaries)
+	print('%s sessions' % merged['sessions'])
+	print('%-32s %8s %10s %10s %10s %10s' % ('span', 'calls', 'total s', 'mean s', 'p90 s', 'max s'))
+	for name, hist in sorted(merged['histograms'].items(), key = lambda elem: -elem[1]['sum']):
+		if name.endswith('.seconds'):
+			print('%-32s %8s %10.3f %10.3f %10.3f %10.3f' % (name[:-8], hist['count'], hist['sum'], hist['mean'], hist['p90'], hist['max']))
+	for name, val in sorted(merged['counters'].items()):
+		if not name.endswith('.calls'):
+			print('%-32s %s' % (name, val))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Relevant libraries
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from source2raw import Source2Raw
+from batch_source2raw import convert_session, export_participants, read_manifest, session_gz_threads
+import io_scheduler
+from fsutil import atomic_write_json, read_json
+
+class SessionWatcher():
+	
+	def __init__(self, mapping, statefile, mrsource = Source2Raw.mrsource, scanners = Source2Raw.mrscanners, settle = 300, since = 2, max_workers = 2, max_pending = 4, logdir = None, options = None, scheduler = None, backfill = None):
+		
+		# DESCRIPTION: watch scanner folders for new sessions and convert them once they stop changing
+		# mapping: tsv with columns mr_id (prefix), raw_id, project_id, cimbi_id; re-read when it changes
+		# settle: seconds a session must stay unchanged (file count, size, mtime) before it is converted (polling, works on NFS)
+		# since: only sessions modified within this many days are watched
+		# scheduler: IOScheduler ordering conversions (new sessions before backfill, fair share across archives, adaptive limits)
+		# backfill: sessions (e.g. from a manifest) converted at low priority whenever no new session is waiting
+		
+		self.mapping = mapping
+		self.statefile = statefile
+		self.mrsource = mrsource
+		self.scanners = scanners
+		self.settle = settle
+		self.since = since
+		self.max_workers = max_workers
+		self.max_pending = max_pending
+		self.logdir = logdir
+		self.options = options or {}
+		
+		self.mapping_mtime = None
+		self.rules = []
+		self.unmapped = set()
+		self.running = {}
+		self.tasks = {}
+		self.scheduler = scheduler or io_scheduler.IOScheduler(max_pending, mrsource = mrsource, scanners = scanners)
+		
+		# restart-safe state: sessions done/failed are not converted again, queued ones are picked up again
+		# seen: mr_id -> [signature, time signature last changed] (kept across restarts/cron runs for settle detection)
+		self.state = read_json(self.statefile, {})
+		# throttle: filesystem limits learned by the scheduler
+		for key in ['done', 'failed', 'queued', 'seen', 'throttle']:
+			self.state.setdefault(key, {})
+		self.seen = self.state['seen']
+		self.scheduler.restore(self.state['throttle'])
+		if self.state['queued']:
+			print('Re-queuing %s sessions from %s' % (len(self.state['queued']), self.statefile))
+		
+		added = 0
+		for session in backfill or []:
+			mr_id = session['mr_id']
+			if mr_id not in self.state['done'] and mr_id not in self.state['failed'] and mr_id not in self.state['queued']:
+				self.state['queued'][mr_id] = dict(session, priority = 'backfill')
+				added += 1
+		if added:
+			print('Backfill: %s sessions queued' % added)
+			self.save_state()
+	
+	def save_state(self):
+		
+		atomic_write_json(self.statefile, self.state, indent = 1)
+	
+	def load_mapping(self):
+		
+		# DESCRIPTION: (re)load mr_id -> project/subject table if it changed
+		
+		mtime = os.stat(self.mapping).st_mtime
+		if mtime == self.mapping_mtime:
+			return
+		with open(self.mapping, newline = '') as f:
+			rows = [row for row in csv.DictReader(f, delimiter = '\t') if row.get('mr_id')]
+		
+		# longest prefix first, so specific entries win over general ones
+		self.rules = sorted(rows, key = lambda row: -len(row['mr_id']))
+		self.mapping_mtime = mtime
+		self.unmapped = set()
+		print('Mapping loaded: %s (%s rows)' % (self.mapping, len(self.rules)))
+	
+	def lookup(self, mr_id):
+		
+		for row in self.rules:
+			if mr_id.startswith(row['mr_id']):
+				return {'raw_id': row['raw_id'], 'project_id': row['project_id'], 'cimbi_id': row['cimbi_id'], 'mr_id': mr_id}
+		return None
+	
+	def signature(self, sessionfolder):
+		
+		# DESCRIPTION: (number of files, total size, latest mtime) of a session folder; unchanged signature = data has landed
+		
+		nfiles = 0
+		nbytes = 0
+		mtime = 0
+		for root, dirs, files in os.walk(sessionfolder):
+			for fname in files:
+				try:
+					st = os.stat(os.path.join(root, fname))
+				except FileNotFoundError:
+					continue # file moved while scanning
+				nfiles += 1
+				nbytes += st.st_size
+				mtime = max(mtime, st.st_mtime)
+		return [nfiles, nbytes, mtime]
+	
+	def poll(self):
+		
+		# DESCRIPTION: scan scanner folders and queue sessions that have settled
+		
+		now = time.time()
+		cutoff = now - self.since * 86400
+		changed = False
+		for scanner in self.scanners.values():
+			scannerfolder = Path(self.mrsource, scanner)
+			if not os.path.isdir(scannerfolder):
+				continue
+			with os.scandir(scannerfolder) as it:
+				entries = [entry for entry in it if entry.is_dir() and entry.name[0] in self.scanners and self.scanners[entry.name[0]] == scanner]
+			for entry in entries:
+				mr_id = entry.name
+				if mr_id in self.state['done'] or mr_id in self.state['failed'] or mr_id in self.state['queued']:
+					continue
+				if entry.stat().st_mtime < cutoff:
+					continue
+				
+				session = self.lookup(mr_id)
+				if session is None:
+					if mr_id not in self.unmapped:
+						print('No mapping for %s, waiting' % mr_id)
+						self.unmapped.add(mr_id)
+					continue
+				
+				signature = self.signature(entry.path)
+				if mr_id not in self.seen or self.seen[mr_id][0] != signature:
+					self.seen[mr_id] = [signature, now]
+					changed = True
+				elif now - self.seen[mr_id][1] >= self.settle:
+					print('Session settled: %s (%s files), queued' % (mr_id, signature[0]))
+					self.state['queued'][mr_id] = dict(session, priority = 'prospective')
+					del self.seen[mr_id]
+					changed = True
+		
+		if changed:
+			self.save_state()
+	
+	def harvest(self):
+		
+		# DESCRIPTION: collect finished conversions
+		
+		finished = [mr_id for mr_id, future in self.running.items() if future.done()]
+		for mr_id in finished:
+			future = self.running.pop(mr_id)
+			task = self.tasks.pop(mr_id)
+			try:
+				result = future.result()
+			except Exception as e:
+				result = dict(self.state['queued'][mr_id], status = 'failed', message = '%s: %s' % (type(e).__name__, e))
+			self.scheduler.finish(task, result)
+			session = self.state['queued'].pop(mr_id)
+			self.state['done' if result['status'] == 'ok' else 'failed'][mr_id] = dict(session, message = result['message'], finished = time.strftime('%Y-%m-%dT%H:%M:%S'))
+			print('%s %s: %s' % (result['status'].upper(), mr_id, result['message']))
+			export_participants([result])
+		if finished:
+			self.state['throttle'] = self.scheduler.state()
+			self.save_state()
+	
+	def submit(self, pool):
+		
+		# DESCRIPTION: hand queued sessions to the scheduler and start those it allows; at most max_pending in flight (backpressure, the rest stay queued)
+		
+		for mr_id, session in self.state['queued'].items():
+			if mr_id not in self.tasks:
+				self.tasks[mr_id] = self.scheduler.add(session, session.get('priority', 'prospective'))
+		futures = self.scheduler.dispatch(pool, convert_session, self.logdir, dict(self.options, mrsource = self.mrsource, export_participants = False))
+		for future, task in futures.items():
+			session = task['session']
+			print('Converting %s -> %s %s (%s)' % (session['mr_id'], session['project_id'], session['cimbi_id'], session.get('priority', 'prospective')))
+			self.running[session['mr_id']] = future
+	
+	def run(self, interval = 60, once = False):
+		
+		# DESCRIPTION: main loop: poll, convert, repeat
+		# once: single poll, convert whatever is queued and exit (settle state is kept in the state file between runs)
+		
+		if self.logdir:
+			os.makedirs(self.logdir, exist_ok = True)
+		with ProcessPoolExecutor(max_workers = self.max_workers) as pool:
+			self.load_mapping()
+			self.poll()
+			while True:
+				self.harvest()
+				self.submit(pool)
+				if once:
+					if not self.running and not self.state['queued']:
+						break
+					time.sleep(1)
+					continue
+				time.sleep(interval)
+				self.load_mapping()
+				self.poll()
+
+if __name__ == '__main__':
+	
+	parser = argparse.ArgumentParser(description = 'Watch MRraw scanner folders and convert new sessions to BIDS as they land.')
+	parser.add_argument('mapping', help = 'tsv with columns mr_id (prefix), raw_id, project_id, cimbi_id')
+	parser.add_argument('--state', default = 'source2raw_watch_state.json', help = 'state file (done/failed/queued sessions)')
+	parser.add_argument('--mrsource', default = Source2Raw.mrsource, help = 'MRraw folder with one subfolder per scanner')
+	parser.add_argument('--interval', type = int, default = 60, help = 'seconds between polls')
+	parser.add_argument('--settle', type = int, default = 300, help = 'seconds a session must be unchanged before conversion')
+	parser.add_argument('--since', type = float, default = 2, help = 'only watch sessions modified within this many days')
+	parser.add_argument('-j', '--jobs', type = int, default = 2, help = 'sessions converted in parallel')
+	parser.add_argument('--max_pending', type = int, default = 4, help = 'maximum sessions handed to the worker pool at once')
+	parser.add_argument('--logdir', help = 'per-session log folder')
+	parser.add_argument('--once', action = 'store_true', help = 'convert what has settled and exit (e.g., from cron)')
+	parser.add_argument('--backfill', help = 'manifest (columns raw_id, project_id, cimbi_id, mr_id) of older sessions converted when no new session is waiting')
+	io_scheduler.add_arguments(parser)
+	args = parser.parse_args()
+	
+	if not os.path.exists(args.mapping):
+		sys.exit('Mapping file not found: %s' % args.mapping)
+	
+	try:
+		scheduler = io_scheduler.from_args(args, args.max_pending, args.mrsource)
+	except ValueError as e:
+		sys.exit(str(e))
+	backfill = read_manifest(args.backfill) if args.backfill else None
+	watcher = SessionWatcher(args.mapping, args.state, mrsource = args.mrsource, settle = args.settle, since = args.since, max_workers = args.jobs, max_pending = args.max_pending, logdir = args.logdir, options = {'d2n_workers': 1, 'gz_threads': session_gz_threads(args.jobs)}, scheduler = scheduler, backfill = backfill)
+	watcher.run(interval = args.interval, once = args.once)